@@ -1,5 +1,3 @@
-from nltk.tokenize import sent_tokenize, word_tokenize
-import nltk
 import json
 import os
 import smatch
@@ -14,6 +12,9 @@ from efficiency.function import  shell
 from efficiency.log import fwrite, fread
 import contextlib
 import io
+import hashlib
+import math
+from collections import Counter, OrderedDict
 
 # from efficiency.log import fwrite, fread
 
@@ -33,26 +34,31 @@ google_amr_data_dir = r"~/Google Drive/My Drive/Zhijing&Yuen/amr_codes/data/"
 google_pred_dir = r"~/Google Drive/My Drive/Zhijing&Yuen/amr_codes/data/predictions"
 
 
-def extract_amr(s):
-    match = re.search(r'\. \((.*)\)', s)
-    if match:
-        return "(" + match.group(1) + ")"
+# tried in order, the first pattern found anywhere in the response wins
+_extract_amr_patterns = [re.compile(r'\. \((.*)\)'), re.compile(r'\: \((.*)\)'),
+                         re.compile(r'\" \((.*)\)'), re.compile(r' \((.*)\)')]
 
-    match = re.search(r'\: \((.*)\)', s)
-    if match:
-      return "(" + match.group(1) + ")"
 
-    match = re.search(r'\" \((.*)\)', s)
-    if match:
-      return "(" + match.group(1) + ")"
+def extract_amr(s):
+    # every pattern needs " (", skip the regexes for responses without it
+    if ' (' not in s:
+        return None
+    for pattern in _extract_amr_patterns:
+        match = pattern.search(s)
+        if match:
+            return "(" + match.group(1) + ")"
+    # print("No match in ", s)
+    return None
 
-    match = re.search(r' \((.*)\)', s)
-    if match:
-      return "(" + match.group(1) + ")"
 
-    else:
-      # print("No match in ", s)
-      return None
+def extract_amr_column(responses, clean=True):
+    """extract_amr over a whole column of LLM responses, followed by parse_string if clean.
+    Missing responses give None."""
+    amrs = []
+    for response in responses:
+        amr = extract_amr(response) if isinstance(response, str) else None
+        amrs.append(parse_string(amr) if clean else amr)
+    return pd.Series(amrs, index=responses.index, dtype=object)
 
 
 def replace_sentence(s):
@@ -61,58 +67,94 @@ def replace_sentence(s):
     pattern = r"The abstract meaning representation.*as follows:"
     return re.sub(pattern, '', s).strip()
 
-def parse_string(s):
+# AMR string cleanup: '[' and ']' become brackets, "~N" alignments are dropped, whitespace runs become a single
+# space and optionally "/" not surrounded by spaces is escaped. Precompiled patterns with literal replacements
+# keep every step in C, which is faster than a single pattern with a python replacement function.
+_alignment_pattern = re.compile(r"~\d+")
+_whitespace_pattern = re.compile(r"\s+")
+_slash_pattern = re.compile(r"(?<! )/(?! )")
+_paren_pattern = re.compile(r"[()]")
+
+
+def normalize_amr(s, escape_slashes=False):
+    if escape_slashes:
+        s = _slash_pattern.sub(r"\/", s)
+    s = s.replace("[", "(").replace("]", ")")
+    s = _alignment_pattern.sub("", s)
+    s = _whitespace_pattern.sub(" ", s)
+    return s
+
+
+def last_bracket_group(s):
+    """Tail of s starting at the bracket that closes the last bracket group, the last character
+    if s does not end with a bracket, s itself if the brackets never balance."""
+    if not s or s[-1] not in '()':
+        return s[-1:]
     count_open = 0
     count_close = 0
-    if s is None:
-        return None
-    try:
-        s = s.replace("[", "(").replace("]", ")")
-        s = re.sub("~\d+", "", s)
-        s = re.sub("\t", " ", s)
-        s = re.sub("\s+", " ", s)
-    except Exception as e:
-        return None
-
-    for i in range(len(s)-1, -1, -1):
+    parens = [match.start() for match in _paren_pattern.finditer(s)]
+    for i in reversed(parens):
         if s[i] == ')':
             count_close += 1
-        elif s[i] == '(':
+        else:
             count_open += 1
         if count_open == count_close:
             return s[i:]
     return s
 
 
+def parse_string(s):
+    if s is None:
+        return None
+    try:
+        s = normalize_amr(s)
+    except Exception as e:
+        return None
+    return last_bracket_group(s)
+
+
 
 
 def parse_string_simple(s):
-    def escape_slash_not_surrounded_by_spaces(text):
-        return re.sub(r'(?<! )/(?! )', r'\/', text)
-    s = escape_slash_not_surrounded_by_spaces(s)
-    s = s.replace("[", "(").replace("]", ")")
-    s = re.sub("~\d+", "", s)
-    s = re.sub("\t", " ", s)
-    s = re.sub("\s+", " ", s)
-    return s
+    return normalize_amr(s, escape_slashes=True)
 
 def balance_parentheses(s):
+    """Drop every ')' without an opening bracket and every '(' that is never closed."""
     if s is None:
         return None
     stack = []
-    for i in range(len(s)):
-        if s[i] == '(':
-            stack.append(i)
-        elif s[i] == ')':
-            if stack:
-                stack.pop()
-            else:
-                s = s[:i] + s[i+1:]
-                return balance_parentheses(s)
-    while stack:
-        i = stack.pop()
-        s = s[:i] + s[i+1:]
-    return s
+    unmatched = []
+    for match in _paren_pattern.finditer(s):
+        if match.group() == '(':
+            stack.append(match.start())
+        elif stack:
+            stack.pop()
+        else:
+            unmatched.append(match.start())
+    if not stack and not unmatched:
+        return s
+    drop = sorted(unmatched + stack)
+    pieces = []
+    start = 0
+    for i in drop:
+        pieces.append(s[start:i])
+        start = i + 1
+    pieces.append(s[start:])
+    return ''.join(pieces)
+
+
+def benchmark_amr_repair(input_file=current_dir / 'final_results_logic_corrected.csv', amr_col='amr', repeat=5):
+    """Throughput of parse_string, parse_string_simple and balance_parentheses on an AMR column."""
+    import time
+    amrs = [amr for amr in pd.read_csv(input_file)[amr_col] if isinstance(amr, str)]
+    n_bytes = sum(len(amr.encode('utf-8')) for amr in amrs)
+    for func in [parse_string, parse_string_simple, balance_parentheses]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for amr in amrs:
+                func(amr)
+        seconds = (time.perf_counter() - start) / repeat
+        print(f"{func.__name__}: {len(amrs) / seconds:.0f} amrs/s, {n_bytes / seconds / 2**20:.1f} MB/s")
 
 
 def premise_generator(premise_list):
@@ -123,42 +165,168 @@ def hypothesis_generator(hypothesis_list):
     for hypothesis in hypothesis_list:
         yield hypothesis.strip()
 
-def compute_smatch_for_pairs(premise_list, hypothesis_list):
+#################### parsed AMR cache ####################
+# every scorer below reads parsed AMRs from here, so each distinct AMR string is parsed once per run
+AMR_CACHE_SIZE = 100000
+_amr_cache = OrderedDict()
+_amr_cache_stats = {'hits': 0, 'misses': 0}
+
+
+class ParsedAMR:
+    """One parsed AMR string: the smatch graph and its triples with the original node names."""
+    __slots__ = ('graph', 'triples', 'triples2', 'error')
+
+    def __init__(self, amr):
+        self.graph = None
+        self.triples = None
+        self.triples2 = None
+        self.error = None
+        try:
+            self.graph = smatch.amr.AMR.parse_AMR_line(amr)
+        except Exception as e:
+            self.error = str(e)
+        if self.graph is None:
+            self.error = self.error or f"Error in parsing amr: {amr}"
+            return
+        self.triples = self.graph.get_triples()
+        self.triples2 = self.graph.get_triples2()
+
+    def renamed_triples(self, prefix):
+        """Triples with nodes renamed to prefix + node_index, like AMR.rename_node but without
+        touching the cached graph."""
+        node_map = {node: prefix + str(i) for i, node in enumerate(self.graph.nodes)}
+        instance, attributes, relation = self.triples
+        return ([(r, node_map[u], v) for r, u, v in instance],
+                [(r, node_map[u], v) for r, u, v in attributes],
+                [(r, node_map[u], node_map[v]) for r, u, v in relation])
+
+
+def amr_key(amr):
+    return hashlib.blake2b(amr.encode('utf-8'), digest_size=16).digest()
+
+
+def get_parsed_amr(amr):
+    """Cached ParsedAMR for an AMR string (None if amr is not a string).
+    The cache is keyed by a hash of the string and keeps the AMR_CACHE_SIZE most recently used AMRs."""
+    if not isinstance(amr, str):
+        return None
+    key = amr_key(amr)
+    parsed = _amr_cache.get(key)
+    if parsed is not None:
+        _amr_cache_stats['hits'] += 1
+        _amr_cache.move_to_end(key)
+        return parsed
+    _amr_cache_stats['misses'] += 1
+    parsed = ParsedAMR(amr)
+    _amr_cache[key] = parsed
+    if len(_amr_cache) > AMR_CACHE_SIZE:
+        _amr_cache.popitem(last=False)
+    return parsed
+
+
+def amr_cache_info():
+    return {**_amr_cache_stats, 'size': len(_amr_cache), 'maxsize': AMR_CACHE_SIZE}
+
+
+def clear_amr_cache():
+    _amr_cache.clear()
+    _amr_cache_stats['hits'] = _amr_cache_stats['misses'] = 0
+
+
+def _smatch_triples(triples1, triples2):
+    """Smatch score for two renamed triple sets, returns (score, warned)."""
     import warnings
-    import smatch
+    with warnings.catch_warnings(record=True) as w:
+        smatch.match_triple_dict.clear()
+        best_mapping, best_match_num = smatch.get_best_match(*triples1, *triples2, "a", "b")
+        test_triple_num = sum(len(t) for t in triples1)
+        gold_triple_num = sum(len(t) for t in triples2)
+        precision, recall, score = smatch.compute_f(best_match_num, test_triple_num, gold_triple_num)
+        smatch.match_triple_dict.clear()
+        return min(score, 1), bool(w)
+
+
+def _smatch_pair(triples1, triples2, hypothesis):
+    """Score one pair of renamed triples, returns (score, invalid_amr, invalid_type, counts_as_invalid)."""
+    try:
+        score, warned = _smatch_triples(triples1, triples2)
+        # Check if any warnings were captured
+        # If so, count the pair as invalid but keep its score
+        return score, 0, None, warned
+    except Exception as e:
+        print('invalid amr', hypothesis)
+        return None, 1, str(e), True
+
+
+def _smatch_chunk(jobs):
+    """Score a chunk of pairs inside a worker process. Every worker owns its own copy
+    of the smatch module, so the global match_triple_dict is never shared."""
+    return [_smatch_pair(*job) for job in jobs]
+
+
+def _init_smatch_worker():
+    smatch.match_triple_dict.clear()
+
+
+def _smatch_job(premise, hypothesis):
+    """Renamed triples of a pair from the AMR cache as (job, None), or (None, result) with the
+    invalid result if one side does not parse."""
+    parsed = []
+    for amr in premise, hypothesis:
+        amr_parsed = get_parsed_amr(amr)
+        if amr_parsed is None or amr_parsed.graph is None:
+            print('invalid amr', hypothesis)
+            error = amr_parsed.error if amr_parsed is not None else f"Error in parsing amr: {amr}"
+            return None, (None, 1, error, True)
+        parsed.append(amr_parsed)
+    try:
+        return (parsed[0].renamed_triples("a"), parsed[1].renamed_triples("b"), hypothesis), None
+    except Exception as e:
+        print('invalid amr', hypothesis)
+        return None, (None, 1, str(e), True)
+
+
+def compute_smatch_for_pairs(premise_list, hypothesis_list, n_jobs=None, chunk_size=64):
+    """Smatch score for every (pred, gold) pair.
+    AMRs are parsed once through the AMR cache in this process, then the triple matching is split
+    into chunks of chunk_size and run by a pool of n_jobs processes (default: all cores,
+    n_jobs=1 scores serially in this process). Results keep the input order."""
+    from concurrent.futures import ProcessPoolExecutor
+    results = []
+    jobs = []
+    for premise, hypothesis in zip(premise_list, hypothesis_list):
+        if premise is None or hypothesis is None:
+            results.append((0, None, None, False))
+            continue
+        job, result = _smatch_job(premise, hypothesis)
+        # result stays None for valid pairs and is filled with the worker result below
+        results.append(result)
+        if job is not None:
+            jobs.append(job)
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    if n_jobs == 1 or len(chunks) <= 1:
+        scored = [_smatch_pair(*job) for job in tqdm(jobs)]
+    else:
+        scored = []
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_smatch_worker) as executor:
+            # executor.map yields chunks in submission order
+            for chunk_results in tqdm(executor.map(_smatch_chunk, chunks), total=len(chunks)):
+                scored.extend(chunk_results)
+    scored = iter(scored)
+    results = [next(scored) if result is None else result for result in results]
+
     scores = []
     invalid_amr = []
     invalid_type = []
     invalid_count = 0
-    for premise, hypothesis in tqdm(zip(premise_list, hypothesis_list)):
-        if premise is None or hypothesis is None:
-            scores.append(0)
-            continue
-
-        try:
-            with warnings.catch_warnings(record=True) as w:
-                smatch.match_triple_dict.clear()
-                best_match_num, test_triple_num, gold_triple_num = smatch.get_amr_match(premise, hypothesis)
-                precision, recall, score = smatch.compute_f(best_match_num, test_triple_num, gold_triple_num)
-                score = min(score, 1)
-                scores.append(score)
-                smatch.match_triple_dict.clear()
-                # Check if any warnings were captured
-                if w:
-                    # If so, append the warning message to invalid_type
-                    # invalid_type.append(str(w[-1].message))
-                    invalid_type.append(None)
-                    invalid_amr.append(0)
-                    invalid_count += 1
-                else:
-                    invalid_amr.append(0)
-                    invalid_type.append(None)
-        except Exception as e:
-            invalid_amr.append(1)
-            print('invalid amr', hypothesis)
-            invalid_type.append(str(e))
-            invalid_count += 1
-            scores.append(None)  # or some other default score
+    for score, invalid, error, counts_as_invalid in results:
+        scores.append(score)
+        if invalid is not None:
+            invalid_amr.append(invalid)
+            invalid_type.append(error)
+        invalid_count += counts_as_invalid
     print('len(invalid_type)', len(invalid_type))
     return scores, invalid_count, invalid_amr, invalid_type
 
@@ -168,15 +336,12 @@ def instance_relation_match(amr1_input, amr2_input):
   if amr1_input is None or amr2_input is None:
     return 0,0
 
-  try:
-      amr1 = smatch.amr.AMR.parse_AMR_line(amr1_input)
-      amr2 = smatch.amr.AMR.parse_AMR_line(amr2_input)
-  except Exception as e:
-      return 0,0
-  if amr1 is None or amr2 is None:
+  amr1 = get_parsed_amr(amr1_input)
+  amr2 = get_parsed_amr(amr2_input)
+  if amr1 is None or amr2 is None or amr1.graph is None or amr2.graph is None:
     return 0,0
-  instance_t, relation_t = amr1.get_triples2()
-  instance_t2, relation_t2 = amr2.get_triples2()
+  instance_t, relation_t = amr1.triples2
+  instance_t2, relation_t2 = amr2.triples2
   def quantify_similarity(list1, list2):
       matches = sum(1 for a, b in zip(list1, list2) if a == b)
       avg_length = (len(list1) + len(list2)) / 2
@@ -194,6 +359,111 @@ def instance_relation_match(amr1_input, amr2_input):
 
 
 
+#################### SemBLEU ####################
+# SemBLEU (Song and Gildea, 2019): BLEU over AMR graph n-grams instead of word n-grams. Unigrams are
+# concepts and constants, bigrams are (concept, role, concept) edges and trigrams paths of two edges.
+# Scores use NIST geometric smoothing and are reweighted to the highest n-gram order of the hypothesis.
+SEMBLEU_MAX_NGRAM = 3
+
+
+def amr_ngrams(amr, max_n=SEMBLEU_MAX_NGRAM):
+    """Counter of the graph n-grams (orders 1 to max_n) of an AMR string, None if it does not parse."""
+    parsed = get_parsed_amr(amr)
+    if parsed is None or parsed.graph is None:
+        return None
+    instance, attributes, relation = parsed.triples
+    concepts = {node: concept for _, node, concept in instance}
+    ngrams = Counter((concept,) for _, _, concept in instance)
+    # node -> outgoing (role, label of the child, child node or None for constants)
+    edges = {}
+    for role, node, value in attributes:
+        if role != 'TOP':
+            ngrams[(value,)] += 1
+            edges.setdefault(node, []).append((role, value, None))
+    for role, node, child in relation:
+        edges.setdefault(node, []).append((role, concepts.get(child, child), child))
+
+    paths = [((concept,), node) for _, node, concept in instance]
+    for _ in range(max_n - 1):
+        longer_paths = []
+        for gram, node in paths:
+            for role, label, child in edges.get(node, []):
+                longer = gram + (role, label)
+                ngrams[longer] += 1
+                if child is not None:
+                    longer_paths.append((longer, child))
+        paths = longer_paths
+    return ngrams
+
+
+def _sembleu_stats(hyp_ngrams, ref_ngrams, max_n=SEMBLEU_MAX_NGRAM):
+    """(clipped matches per order, hypothesis n-grams per order, hypothesis length, reference length)"""
+    matches = [0] * max_n
+    totals = [0] * max_n
+    for gram, count in hyp_ngrams.items():
+        order = (len(gram) - 1) // 2
+        totals[order] += count
+        matches[order] += min(count, ref_ngrams.get(gram, 0))
+    hyp_len = totals[0]
+    ref_len = sum(count for gram, count in ref_ngrams.items() if len(gram) == 1)
+    return matches, totals, hyp_len, ref_len
+
+
+def _sembleu_from_stats(matches, totals, hyp_len, ref_len):
+    if hyp_len == 0 or matches[0] == 0:
+        return 0.0
+    # auto reweigh: uniform weights over the orders the hypothesis has
+    max_order = max(n + 1 for n, total in enumerate(totals) if total > 0)
+    log_precision = 0
+    smoothing = 1
+    for n in range(max_order):
+        if matches[n] > 0:
+            precision = matches[n] / totals[n]
+        else:
+            smoothing *= 2
+            precision = 1 / (smoothing * totals[n])
+        log_precision += math.log(precision) / max_order
+    brevity_penalty = 1 if hyp_len > ref_len else math.exp(1 - ref_len / hyp_len)
+    return brevity_penalty * math.exp(log_precision)
+
+
+def sembleu_scores(hypotheses, references, max_n=SEMBLEU_MAX_NGRAM):
+    """SemBLEU of every (hypothesis, reference) AMR pair, None where one side does not parse."""
+    scores = []
+    for hypothesis, reference in zip(hypotheses, references):
+        hyp_ngrams = amr_ngrams(hypothesis, max_n)
+        ref_ngrams = amr_ngrams(reference, max_n)
+        if hyp_ngrams is None or ref_ngrams is None:
+            scores.append(None)
+            continue
+        scores.append(_sembleu_from_stats(*_sembleu_stats(hyp_ngrams, ref_ngrams, max_n)))
+    return scores
+
+
+def corpus_sembleu(hypotheses, references, max_n=SEMBLEU_MAX_NGRAM):
+    """Corpus SemBLEU, n-gram statistics summed over all pairs that parse."""
+    matches = [0] * max_n
+    totals = [0] * max_n
+    hyp_len = ref_len = 0
+    for hypothesis, reference in zip(hypotheses, references):
+        hyp_ngrams = amr_ngrams(hypothesis, max_n)
+        ref_ngrams = amr_ngrams(reference, max_n)
+        if hyp_ngrams is None or ref_ngrams is None:
+            continue
+        pair_matches, pair_totals, pair_hyp_len, pair_ref_len = _sembleu_stats(hyp_ngrams, ref_ngrams, max_n)
+        matches = [a + b for a, b in zip(matches, pair_matches)]
+        totals = [a + b for a, b in zip(totals, pair_totals)]
+        hyp_len += pair_hyp_len
+        ref_len += pair_ref_len
+    return _sembleu_from_stats(matches, totals, hyp_len, ref_len)
+
+
+
+
+
+
+
+
 #################### AMR complexity features ####################
 def amr_depth(amr):
     max_depth = 0
@@ -240,27 +510,155 @@ def unique_roles(amr):
     return len(roles)
 
 
+# AMR lexer following the splitting rules of nltk's word_tokenize (NLTKWordTokenizer) without the
+# punkt sentence splitter: brackets, quotes and most punctuation are their own tokens, ':' and ','
+# only when not followed by a digit, clitics ('s, n't, ...) split off the end of a word
+_split_chars = r"\]\[(){}<>\"`;@#$%&?!*«“‘„»”’\u2012-\u2015"
+# a '"' or "''" after a space is a starting quote (``) for nltk and ends the tail
+_final_period_tail = r"(?:[\])}>»”’ ]|(?<![ ])\"|'(?!(?<=[ ]')'))*\s*\Z"
+# nltk pads ':'/',' together with the next character, so the second one of a pair like '::' sticks to the next token
+_second_colon = r"(?:(?<=(?<![:,])[:,])|(?<=(?<![:,])[:,][:,][:,]))[:,]"
+_word_char = (rf"(?:[^\s{_split_chars}:,.'-]|[:,](?=\d)|{_second_colon}|\.(?!\.|{_final_period_tail})|-(?!-)"
+              r"|(?:(?<=\w)'|'(?!\w)|'(?=(?i:re|ve|ll|m|t|s|d|n)\b))(?!'))")
+_clitic = rf"(?<!')(?:(?:'ll|'LL|'re|'RE|'ve|'VE|n't|N'T)(?:'[sSmMdD]|')?|'[sSmMdD]|')(?!{_word_char})"
+_amr_token_pattern = re.compile(rf"""
+    \.{{2,}} | -- | ``? | '' | [{_split_chars}]
+  | (?!{_second_colon})[:,](?!\d)
+  | (?<=[^.])\.(?={_final_period_tail})
+  | (?<!\w)'(?=\w)(?!(?i:re|ve|ll|m|t|s|d|n)\b)
+  | {_word_char}+?(?={_clitic}|(?!{_word_char}))
+  | \S
+""", re.VERBOSE)
+# most AMRs only need brackets, quotes, ':role' and ',' split off; the full pattern above is used when
+# one of the rules that depend on more context (apostrophes, '..', '--', '::', final period, contractions) applies
+_amr_simple_token_pattern = re.compile(
+    rf"(?:[^\s{_split_chars}:,]|[:,](?=\d))[^\s{_split_chars}:,]*(?:[:,](?=\d)[^\s{_split_chars}:,]*)*"
+    rf"|[{_split_chars}]|[:,]")
+_amr_special_substrings = ["'", '`', '--', '..', '::', ',,', ':,', ',:']
+_amr_contraction_words = ['cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna']
+
+
+def _needs_full_amr_lexer(amr):
+    if any(special in amr for special in _amr_special_substrings):
+        return True
+    # nltk splits off the period ending the text, ignoring closing brackets and quotes
+    end = amr.rstrip().rstrip(' \'"])}>»”’')
+    if end.endswith('.'):
+        return True
+    lowered = amr.lower()
+    return any(word in lowered for word in _amr_contraction_words)
+
+
+# words nltk splits in two (cannot -> can not, gonna -> gon na, ...), cutting them off the rest of the token as well
+_amr_contraction_pattern = re.compile(r"(?i)\b(?:cannot|d'ye|gimme|gonna|gotta|lemme|more'n)\b|\bwanna\Z")
+_amr_contraction_split = re.compile(r"(?i)can|d|gim|gon|got|lem|more|wan")
+
+
+def amr_tokenize(amr):
+    """Tokens of an AMR string, as nltk.word_tokenize(amr, preserve_line=True) would split them
+    (double quotes are kept as '"'). tests/test_amr_tokens.py pins the counts on the final_results CSVs.
+
+    Known differences from nltk:
+    - no punkt sentence splitting: nltk.word_tokenize without preserve_line may end a sentence inside a quoted
+      name ("Mr." :op2, "U.S.")) and then split the period off, one token more per split
+    - 't after a split contraction is not cut off ('tis, 'twas after more'n, d'ye, gonna)
+    - a clitic directly followed by a closing single quote stays on its word (b's' gives b's ')
+    """
+    if not _needs_full_amr_lexer(amr):
+        return _amr_simple_token_pattern.findall(amr)
+    tokens = _amr_token_pattern.findall(amr)
+    split_tokens = []
+    for token in tokens:
+        start = 0
+        for match in _amr_contraction_pattern.finditer(token):
+            split = _amr_contraction_split.match(token, match.start()).end()
+            split_tokens += [token[start:match.start()], token[match.start():split], token[split:match.end()]]
+            start = match.end()
+        split_tokens.append(token[start:])
+    return [token for token in split_tokens if token]
+
+
 def amr_tokens(amr):
     if not isinstance(amr, str):
         return 0
-    tokens = nltk.word_tokenize(amr)
-    return len(tokens)
+    return len(amr_tokenize(amr))
+
+
+# the only characters the complexity features look at: brackets and ":role" (a bare ":" still counts for width)
+_complexity_pattern = re.compile(r'[()]|:[a-zA-Z0-9_-]*')
+COMPLEXITY_FEATURES = ['amr_depth', 'amr_width', 'unique_roles', 'amr_tokens']
+
+
+def amr_complexity(amr):
+    """amr_depth, amr_width, unique_roles and amr_tokens of one AMR, the bracket/role features
+    in a single scan of the string."""
+    if not isinstance(amr, str):
+        return 0, 0, 0, 0
+    max_depth = 0
+    current_depth = 0
+    max_width = 0
+    widths = [0]
+    roles = set()
+    for match in _complexity_pattern.finditer(amr):
+        token = match.group()
+        if token == '(':
+            current_depth += 1
+            if current_depth > max_depth:
+                max_depth = current_depth
+            if current_depth >= len(widths):
+                widths.append(0)
+        elif token == ')':
+            if current_depth > 0:
+                current_depth -= 1
+        else:
+            widths[current_depth] += 1
+            max_width = max(max_width, widths[current_depth])
+            if len(token) > 1:
+                roles.add(token)
+    return max_depth, max_width, len(roles), amr_tokens(amr)
+
+
+def amr_complexity_columns(amrs):
+    """Complexity features for a column of AMRs as {feature name: list}, each distinct AMR scanned once."""
+    amrs = list(amrs)
+    features = {amr: amr_complexity(amr) for amr in set(amr for amr in amrs if isinstance(amr, str))}
+    rows = [features[amr] if isinstance(amr, str) else (0, 0, 0, 0) for amr in amrs]
+    return {name: [row[i] for row in rows] for i, name in enumerate(COMPLEXITY_FEATURES)}
+
 
 
+#### AMR store ####
+def amr_store(amrs, id_col='id', amr_col='amr'):
+    """AMRs of corrected_amrs.csv as a Series indexed by id, built once and joined with attach_amrs.
+    The first AMR is kept for duplicated ids."""
+    amrs = amrs.drop_duplicates(subset=id_col, keep='first')
+    return pd.Series(amrs[amr_col].values, index=amrs[id_col].values)
+
+
+def attach_amrs(df, store, columns, id_col='id'):
+    """Add one column per (column name, id suffix) in columns, e.g. {'premise_amr': '_p', 'hypothesis_amr': '_h'},
+    looking up f"{id}{suffix}" in the store. Ids without an AMR get NaN."""
+    ids = df[id_col].astype(str)
+    for col, suffix in columns.items():
+        df[col] = (ids + suffix).map(store).values
+    return df
+
 
 ###### for paired amrs ######
-def get_3_amr_features(df, amr_pred ='premise_amr', amr_gold='hypothesis_amr'):
+def get_3_amr_features(df, amr_pred ='premise_amr', amr_gold='hypothesis_amr', n_jobs=None):
   '''Given a df containing columns ['premise_amr','hypothesis_amr'],
-  add three more columns to df ,['smatch_score','instance_match', 'relation_match']'''
+  add three more columns to df ,['smatch_score','instance_match', 'relation_match'].
+  n_jobs is the number of smatch worker processes (default: all cores)'''
 
   premise_list = df[amr_pred].tolist()
   # print(f"{len(premise_list)} amrs from premises")
   hypothesis_list = df[amr_gold].tolist()
   # print(f"{len(hypothesis_list)} amrs from hypotheses")
 
-  df['smatch_score'], invalid_counts, df['invalid_amr'], df['invalid_type'] = compute_smatch_for_pairs(premise_list, hypothesis_list)
-  df['instance_match'] = df.apply(lambda row: instance_relation_match(row[amr_pred], row[amr_gold])[0], axis=1)
-  df['relation_match'] = df.apply(lambda row: instance_relation_match(row[amr_pred], row[amr_gold])[1], axis=1)
+  df['smatch_score'], invalid_counts, df['invalid_amr'], df['invalid_type'] = compute_smatch_for_pairs(premise_list, hypothesis_list, n_jobs=n_jobs)
+  matches = [instance_relation_match(pred, gold) for pred, gold in zip(premise_list, hypothesis_list)]
+  df['instance_match'] = [match[0] for match in matches]
+  df['relation_match'] = [match[1] for match in matches]
   print(f"{invalid_counts} invalid amrs", f"{len(premise_list)-invalid_counts} valid amrs")
   mean_score = df['smatch_score'].dropna().mean()
   print("Mean smatch score:", mean_score)
@@ -270,44 +668,54 @@ def get_3_amr_features(df, amr_pred ='premise_amr', amr_gold='hypothesis_amr'):
 
 #### For single amrs ####
 def get_amr_features_one_sent(df, amr_col ='amr', col_name_add = ''):
-    func_list = [amr_depth, amr_width, unique_roles, amr_tokens]
-    for func in func_list:
-        df[f'{func.__name__}{col_name_add}'] = df[amr_col].apply(func)
+    features = amr_complexity_columns(df[amr_col])
+    for name in COMPLEXITY_FEATURES:
+        df[f'{name}{col_name_add}'] = features[name]
     return df
 
 
 def get_amr_features_two_sent(df, amr_col1 ='premise_amr', amr_col2 ='hypothesis_amr'):
-    func_list = [amr_depth, amr_width, unique_roles, amr_tokens]
-    for func in func_list:
-        df[f'{func.__name__}_{amr_col1[:3]}'] = df.apply(lambda row: func(row[amr_col1]), axis=1)
-        df[f'{func.__name__}_{amr_col2[:3]}'] = df.apply(lambda row: func(row[amr_col2]), axis=1)
-        df[f'{func.__name__}_avg'] = (df[f'{func.__name__}_{amr_col1[:3]}'] + df[f'{func.__name__}_{amr_col2[:3]}'])/2
+    features1 = amr_complexity_columns(df[amr_col1])
+    features2 = amr_complexity_columns(df[amr_col2])
+    for name in COMPLEXITY_FEATURES:
+        df[f'{name}_{amr_col1[:3]}'] = features1[name]
+        df[f'{name}_{amr_col2[:3]}'] = features2[name]
+        df[f'{name}_avg'] = (df[f'{name}_{amr_col1[:3]}'] + df[f'{name}_{amr_col2[:3]}'])/2
     return df
 
 
-def amr_lbl():
+sembleu_dir = f'{parent_dir}/sembleu'
+
+
+def eval_sh_sembleu(hyp_file, ref_file, skip_reweigh=True):
+    """Score line printed by the reference SemBLEU eval.sh for two AMR files (AMRs separated by empty lines).
+    With skip_reweigh the 'Auto_reweigh, max-gram is ...' notice is passed over to the score itself."""
+    stdout, stderr = shell(f'cd {sembleu_dir} && {sembleu_dir}/eval.sh {hyp_file} {ref_file}')
+    stdout = stdout.split('\n')
+    sembleu_idx = stdout.index('evaluating ...') + 1
+    if skip_reweigh and stdout[sembleu_idx].startswith('Auto_reweigh'):
+        sembleu_idx += 1
+    return stdout[sembleu_idx]
+
+
+def amr_lbl(native=False):
+    """Rescore the paws_amr_30.csv rows whose sembleu cell holds the eval.sh reweighing notice.
+
+    The published column comes from eval.sh; native=True writes the in-process sembleu_scores instead, for
+    use once tests/test_sembleu.py has confirmed parity with eval.sh.
+    """
     dat = pd.read_csv(data_dir / 'paws_amr_30.csv')
-    hyp_file = 'tmp_hyp.txt'
-    prem_file = 'tmp_prem.txt'
-    data = dat[dat['sembleu'] == 'Auto_reweigh, max-gram is 2 new weight is (0.5, 0.5)']
-    for index, row in tqdm(data.iterrows()):
-        hyp = row['hypothesis_amr']
-        prem = row['premise_amr']
-        fwrite(hyp, hyp_file)
-        fwrite(prem, prem_file)
-        os.chdir(f'{parent_dir}/sembleu')
-        cmd = f'{parent_dir}/sembleu/eval.sh {current_dir}/tmp_hyp.txt {current_dir}/tmp_prem.txt'
-        stdout, stderr = shell(cmd)
-        os.chdir(current_dir)
-        stdout = stdout.split('\n')
-        sembleu_idx = stdout.index('evaluating ...') + 1
-        smatch = stdout[sembleu_idx]
-        if 'Auto_reweigh, max-gram is 2 new weight is (0.5, 0.5)' in stdout[sembleu_idx]:
-            smatch = stdout[sembleu_idx + 1]
-        data.loc[index, 'sembleu'] = smatch
-        if index % 100 == 0:
-            print(f'index: {index}, smatch: {smatch}')
-            data.to_csv(data_dir / 'paws_amr_30.csv', index=False)
+    data = dat[dat['sembleu'] == 'Auto_reweigh, max-gram is 2 new weight is (0.5, 0.5)'].copy()
+    if native:
+        data['sembleu'] = sembleu_scores(data['hypothesis_amr'], data['premise_amr'])
+        print(f"mean sembleu: {data['sembleu'].dropna().mean()}")
+    else:
+        hyp_file = f'{current_dir}/tmp_hyp.txt'
+        prem_file = f'{current_dir}/tmp_prem.txt'
+        for index, row in tqdm(data.iterrows()):
+            fwrite(row['hypothesis_amr'], hyp_file)
+            fwrite(row['premise_amr'], prem_file)
+            data.loc[index, 'sembleu'] = eval_sh_sembleu(hyp_file, prem_file)
     data.to_csv(data_dir / 'paws_amr_30.csv', index=False)
 
 
@@ -316,8 +724,7 @@ def scoring_parser_bleu():
     df = pd.read_csv(data_dir / 'sentence2amr.csv')
 
     df_ldc_test = df[df['id'].str.contains('ldc') & df['id'].str.contains('test')].copy()
-    df_ldc_test.loc[:, 'amr'] = df_ldc_test['amr'].apply(extract_amr)
-    df_ldc_test.loc[:, 'amr'] = df_ldc_test['amr'].apply(parse_string)
+    df_ldc_test.loc[:, 'amr'] = extract_amr_column(df_ldc_test['amr'])
 
     df_ldc_test.to_csv(f'{data_dir}/ldc_test.csv', index=False)
     # save 'premise_amr'to one file and 'hypothesis_amr' to another, where datapoints are separated by an empty line
@@ -330,14 +737,7 @@ def scoring_parser_bleu():
         for item in df_ldc_test['amr']:
             f.write("%s\n\n" % item)
 
-    os.chdir(f'{parent_dir}/sembleu')
-    cmd = f'{parent_dir}/sembleu/eval.sh {data_dir}/ldc_parsed_amr.txt {data_dir}/ldc_gold_amr.txt'
-    stdout, stderr = shell(cmd)
-    stdout = stdout.split('\n')
-    sembleu_idx = stdout.index('evaluating ...') + 1
-    sembleu = stdout[sembleu_idx]
-    print(sembleu)
-    os.chdir(current_dir)
+    print(eval_sh_sembleu(f'{data_dir}/ldc_parsed_amr.txt', f'{data_dir}/ldc_gold_amr.txt', skip_reweigh=False))
 
 
 
@@ -345,8 +745,7 @@ def scoring_parser_smatch():
     df = pd.read_csv(data_dir / 'sentence2amr.csv')
 
     df_ldc_test = df[df['id'].str.contains('ldc') & df['id'].str.contains('test')].copy()
-    df_ldc_test.loc[:, 'amr'] = df_ldc_test['amr'].apply(extract_amr)
-    df_ldc_test.loc[:, 'amr'] = df_ldc_test['amr'].apply(parse_string)
+    df_ldc_test.loc[:, 'amr'] = extract_amr_column(df_ldc_test['amr'])
     df_ldc_test.loc[:, 'true_amr'] = df_ldc_test['true_amr'].apply(lambda x: re.sub("~e.\d+", "", x))
     df_ldc_test = get_3_amr_features(df_ldc_test, amr_pred='amr', amr_gold='true_amr')
     df_ldc_test.to_csv(f'{data_dir}/ldc_test.csv', index=False)
@@ -391,8 +790,7 @@ def scoring_gpt_smatch():
 
 def get_amr_features(input_file):
     df = pd.read_csv(input_file)
-    df.loc[:, 'amr'] = df['amr'].apply(extract_amr)
-    df.loc[:, 'amr'] = df['amr'].apply(parse_string)
+    df.loc[:, 'amr'] = extract_amr_column(df['amr'])
     df.loc[:, 'true_amr'] = df['true_amr'].apply(lambda x: re.sub("~e.\d+", "", x))
     df = get_3_amr_features(df, amr_pred='amr', amr_gold='true_amr')
     return df
@@ -428,13 +826,11 @@ def main():
     # paws = get_3_amr_features(paws, amr_pred='premise_amr', amr_gold='hypothesis_amr')
     # paws.to_csv(tct_out_dir/'paws_features.csv', index=False)
 
-    amrs = pd.read_csv(f'{google_pred_dir}/corrected_amrs.csv')
+    amrs = amr_store(pd.read_csv(f'{google_pred_dir}/corrected_amrs.csv'))
 
     # asilm = pd.read_csv(tct_out_dir/'asilm_text_features.csv')
     # asilm['id'] = asilm['id_y']
-    # for index, row in asilm.iterrows():
-    #     asilm.loc[index, 'premise_amr'] = amrs[amrs['id'] == f"{row['id']}_p"]['amr'].values[0]
-    #     asilm.loc[index, 'hypothesis_amr'] = amrs[amrs['id'] == f"{row['id']}_h"]['amr'].values[0]
+    # asilm = attach_amrs(asilm, amrs, {'premise_amr': '_p', 'hypothesis_amr': '_h'})
     #
     #
     # asilm = get_amr_features_two_sent(asilm, amr_col1 = 'premise_amr', amr_col2 = 'hypothesis_amr')
@@ -442,15 +838,13 @@ def main():
     # asilm.to_csv(tct_out_dir/'asilm_features.csv', index=False)
 
     # wmt = pd.read_csv(tct_out_dir/'wmt_text_features.csv')
-    # for index, row in wmt.iterrows():
-    #     wmt.loc[index, 'en_amr'] = amrs[amrs['id'] == f"{row['id']}_en"]['amr'].values[0]
+    # wmt = attach_amrs(wmt, amrs, {'en_amr': '_en'})
     # wmt = get_amr_features_one_sent(wmt, amr_col = 'en_amr')
     # wmt.to_csv(tct_out_dir/'wmt_amr_features.csv', index=False)
 
     # logic = pd.read_csv(tct_out_dir/'logic_text_features.csv')
     # logic['id'] = logic['id_y']
-    # for index, row in logic.iterrows():
-    #     logic.loc[index, 'amr'] = amrs[amrs['id'] == f"{row['id']}"]['amr'].values[0]
+    # logic = attach_amrs(logic, amrs, {'amr': ''})
     #
     # logic = get_amr_features_one_sent(logic, amr_col = 'amr')
     # logic.to_csv(tct_out_dir/'logic_amr_features.csv', index=False)
@@ -459,8 +853,7 @@ def main():
     # pubmed = pd.read_csv(tct_out_dir/'pubmed45_text_features.csv')
     # if 'id_y' in pubmed.columns:
     #     pubmed['id'] = pubmed['id_y']
-    # for index, row in pubmed.iterrows():
-    #     pubmed.loc[index, 'amr'] = amrs[amrs['id'] == f"{row['id']}"]['amr'].values[0]
+    # pubmed = attach_amrs(pubmed, amrs, {'amr': ''})
     #
     # pubmed = get_amr_features_one_sent(pubmed, amr_col = 'amr')
     # pubmed.to_csv(tct_out_dir/'pubmed45_features.csv', index=False)
@@ -469,8 +862,7 @@ def main():
     # spider = pd.read_csv(tct_out_dir/'spider_text_features.csv')
     # if 'id_y' in spider.columns:
     #     spider['id'] = spider['id_y']
-    # for index, row in spider.iterrows():
-    #     spider.loc[index, 'amr'] = amrs[amrs['id'] == f"{row['id']}"]['amr'].values[0]
+    # spider = attach_amrs(spider, amrs, {'amr': ''})
     #
     # spider = get_amr_features_one_sent(spider, amr_col = 'amr')
     # spider.to_csv(tct_out_dir/'spider_amr_features.csv', index=False)
@@ -478,8 +870,7 @@ def main():
     # ldc_ner = pd.read_csv(tct_out_dir/'ldc_ner_text_features.csv')
     # if 'id_y' in ldc_ner.columns:
     #     ldc_ner['id'] = ldc_ner['id_y']
-    # for index, row in ldc_ner.iterrows():
-    #     ldc_ner.loc[index, 'amr'] = amrs[amrs['id'] == f"{row['id']}"]['amr'].values[0]
+    # ldc_ner = attach_amrs(ldc_ner, amrs, {'amr': ''})
     #
     # ldc_ner = get_amr_features_one_sent(ldc_ner, amr_col = 'amr')
     # ldc_ner.to_csv(tct_out_dir/'ldc_ner_amr_features.csv', index=False)
@@ -0,0 +1,34 @@
+import hashlib
+import json
+import os
+import shutil
+from datasets import load_from_disk
+from result_store import parquet_path
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def tokenized_cache_key(file_path, dataset, amr, outcome_variable, tokenizer_name, max_length, formatting=''):
+    """Hash of everything the tokenized dataset depends on; formatting is e.g. the source of process_data."""
+    data_file = file_path if os.path.exists(file_path) else parquet_path(file_path)
+    parts = [file_hash(data_file), dataset, amr, outcome_variable, tokenizer_name, max_length,
+             hashlib.sha256(formatting.encode('utf-8')).hexdigest()]
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:32]
+
+def cached_tokenized_dataset(key, build, cache_dir='cache/tokenized'):
+    """Load the datasets.Dataset stored under key (memory-mapped arrow files), or build() and store it."""
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        print("Loading tokenized dataset from", path)
+        return load_from_disk(path)
+    ds = build()
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.save_to_disk(tmp)
+    os.replace(tmp, path)
+    return load_from_disk(path)
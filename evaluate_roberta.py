@@ -1,7 +1,7 @@
 import pandas as pd
-from transformers import RobertaTokenizer, RobertaForSequenceClassification, AdamW
+from transformers import RobertaTokenizerFast, RobertaForSequenceClassification, AdamW
 import torch
-from transformers import Trainer, TrainingArguments
+from transformers import Trainer, TrainingArguments, DataCollatorWithPadding
 import numpy as np
 from datasets import Dataset, DatasetDict
 from sklearn.metrics import accuracy_score, recall_score, precision_score, f1_score
@@ -12,7 +12,10 @@ from sklearn.model_selection import train_test_split
 from sklearn.utils import class_weight
 from torch import nn
 import transformers
+import inspect
 import wandb
+from result_store import load_results
+from dataset_cache import tokenized_cache_key, cached_tokenized_dataset
 
 def compute_metrics_discrete(eval_pred):
     logits, labels = eval_pred
@@ -30,7 +33,8 @@ def compute_metrics_discrete(eval_pred):
 
 def process_data(file_path,dataset,amr=True,outcome_variable='helpfulness'):
     """Process data for training RoBERTa model, formatting depends on the dataset"""
-    df=pd.read_csv(file_path)
+    text_columns=['premise_','hypothesis_','amr_p','amr_h','text','amr','interaction']
+    df=load_results(file_path,columns=['id',outcome_variable]+text_columns)
     if amr:
         if dataset in ['PAWS']:
             df=df.assign(text="Sentence 1: "+df.premise_+"\nAMR 1: "+df.amr_p+"\nSentence 2: "+df.hypothesis_+"\nAMR 2: "+df.amr_h)
@@ -72,7 +76,8 @@ def split_sets(dataset,df):
 
 
 def tokenize(batch):
-    return tokenizer(batch["text"], padding=True, truncation=True, max_length=512)
+    # no padding here: DataCollatorWithPadding pads each batch to its own longest sequence
+    return tokenizer(batch["text"], truncation=True, max_length=max_length)
 
 def model_init():
     transformers.set_seed(42)
@@ -125,7 +130,20 @@ file_path='../../processed/predictions/final_results_paws.csv'
 logs_path='../../processed/predictions/'
 run_name=dataset+"_hyp_final_"+outcome_variable
 
-df=process_data(file_path=file_path,dataset=dataset,amr=amr_flag,outcome_variable=outcome_variable)
+max_length=512
+tokenizer_name='roberta-large'
+tokenizer = RobertaTokenizerFast.from_pretrained(tokenizer_name)
+
+def build_dataset():
+    df=process_data(file_path=file_path,dataset=dataset,amr=amr_flag,outcome_variable=outcome_variable)
+    return Dataset.from_pandas(df,preserve_index=False).map(tokenize, batched=True)
+
+## tokenized rows are cached on disk; splitting below selects from them by row number
+cache_key=tokenized_cache_key(file_path,dataset,amr_flag,outcome_variable,tokenizer_name,max_length,
+                              inspect.getsource(process_data))
+tokenized=cached_tokenized_dataset(cache_key,build_dataset)
+df=tokenized.select_columns(['id','text','label']).to_pandas()
+df['row']=np.arange(len(df))
 train_set,dev_set,test_set=split_sets(dataset=dataset,df=df)
 
 if compute_weights:
@@ -137,14 +155,10 @@ else:
 ## prepare sets
 set_seed(42)
 torch.manual_seed(42)
-tokenizer = RobertaTokenizer.from_pretrained('roberta-large')
-
-train_dataset=Dataset.from_pandas(train_set)
-val_dataset=Dataset.from_pandas(dev_set)
-test_dataset=Dataset.from_pandas(test_set)
-train_dataset = train_dataset.map(tokenize, batched=True, batch_size=len(train_dataset))
-val_dataset = val_dataset.map(tokenize, batched=True, batch_size=len(val_dataset))
-test_dataset = test_dataset.map(tokenize, batched=True, batch_size=len(test_dataset))
+
+train_dataset=tokenized.select(train_set.row.tolist())
+val_dataset=tokenized.select(dev_set.row.tolist())
+test_dataset=tokenized.select(test_set.row.tolist())
 train_dataset.set_format("torch", columns=["input_ids", "attention_mask", "label"])
 val_dataset.set_format("torch", columns=["input_ids", "attention_mask", "label"])
 test_dataset.set_format("torch", columns=["input_ids", "attention_mask", "label"])
@@ -176,6 +190,7 @@ trainer = CustomTrainer(
     train_dataset=train_dataset,
     eval_dataset=val_dataset,
     compute_metrics=compute_metrics_discrete,
+    data_collator=DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8),
 )
 
 print("##### VALIDATION RESULTS#####")
@@ -8,14 +8,26 @@ from langchain.prompts import (
 )
 from langchain.chains import ConversationChain
 from langchain.memory import ConversationBufferMemory
+from langchain.schema import SystemMessage, HumanMessage
 import pandas as pd
 import re
 import json
 from sklearn.metrics import classification_report
+from sacremoses import MosesDetokenizer
 import numpy as np
 import ast
 import argparse
-from bleu import list_bleu
+import hashlib
+import os
+import asyncio
+import random
+import time
+import timeit
+import urllib.request
+import uuid
+import math
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
 
 prompts_dict={
@@ -92,28 +104,43 @@ Sentence: {sentence_1}\nAMR:\n{amr_1}\nUse json format for the response where ea
 prompts_dict['ldc_dev']=prompts_dict['paws']
 prompts_dict['slang']=prompts_dict['paws']
 
+# prompt placeholder -> dataframe column, per dataset
+prompt_fields={
+    "paws":{'sentence_1':'premise','amr_1':'amr_p','sentence_2':'hypothesis','amr_2':'amr_h'},
+    "slang":{'sentence_1':'premise','amr_1':'true_premise_amr','sentence_2':'hypothesis','amr_2':'hand_hypothesis_amr'},
+    "entity_recog":{'sentence_1':'text','amr_1':'true_amr'},
+    "logic":{'sentence_1':'text','amr_1':'amr'},
+    "pubmed":{'sentence_1':'text','amr_1':'amr','interaction':'interaction'},
+}
+prompt_fields['ldc_dev']=prompt_fields['paws']
+for name in ['newstest','django','spider']:
+    prompt_fields[name]=prompt_fields['logic']
 
-def extract_value(json_str, key):
-    try:
-        json_data = ast.literal_eval(json_str)
-        return json_data[key]
-    except (json.JSONDecodeError, KeyError):
-        return None
 
-def extract_value2(json_str, key):
+def parse_structured(text):
+    """Decode a JSON or Python-literal string; None if it is neither."""
+    if not isinstance(text,str):
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
     try:
-        json_data = json.loads(json_str)
-        return json_data[key]
-    except (json.JSONDecodeError, KeyError):
+        return ast.literal_eval(text)
+    except (ValueError,SyntaxError,TypeError,MemoryError,RecursionError):
         return None
 
+def extract_fields(json_strs,**columns):
+    """Decode every json string once and return {column: values of its key}, None where the key is missing."""
+    decoded=[parse_structured(x) for x in json_strs]
+    return {column:[d.get(key) if isinstance(d,dict) else None for d in decoded] for column,key in columns.items()}
+
 def process_2_clauses(df,amr):
     amr=amr.rename(columns={'id':'id_total'})
     amr['id']=amr.id_total.str[:-2]
     df=df.merge(amr,how='inner',on='id')
     df['id_type']=df.id_total.str[-1:]
-    df['premise'] = df['input_json'].apply(lambda x: extract_value(x, 'premise'))
-    df['hypothesis'] = df['input_json'].apply(lambda x: extract_value(x, 'hypothesis'))
+    df=df.assign(**extract_fields(df['input_json'],premise='premise',hypothesis='hypothesis'))
     df=df.pivot(index=['id','ground_truth','premise','hypothesis'],columns=['id_type'],values=['amr'])
     df=df.reset_index()
 
@@ -126,38 +153,39 @@ def process_2_clauses(df,amr):
     df.columns = [c.rstrip('_') for c in new_columns]
     return df
 
+def read_dataset_csv(path,dataset,usecols=None,chunksize=50000):
+    """Stream a csv in chunks, keeping only the rows whose id contains `dataset` (and only usecols)."""
+    chunks=[chunk.loc[chunk.id.str.contains(dataset,regex=False)]
+            for chunk in pd.read_csv(path,usecols=usecols,chunksize=chunksize)]
+    return pd.concat(chunks)
+
 def process_data(file_path,file_path_amr,dataset):
-    df=pd.read_csv(file_path)
-    amr=pd.read_csv(file_path_amr)
-    df=df.loc[df.id.str.contains(dataset)]
-    amr=amr.loc[amr.id.str.contains(dataset)]
-    df=df.loc[:,['id', 'input_json', 'ground_truth']]
+    df=read_dataset_csv(file_path,dataset,usecols=['id', 'input_json', 'ground_truth'])
+    # all amr columns are kept, they are carried into the outputs
+    amr=read_dataset_csv(file_path_amr,dataset)
     if dataset in ['paws']:
         df=process_2_clauses(df,amr)
     elif dataset in ['django']:
-        df['text'] = df['input_json'].apply(lambda x: extract_value(x, 'nl'))
+        df=df.assign(**extract_fields(df['input_json'],text='nl'))
         df=df.merge(amr,how='inner',on='id')
         df=df.loc[:,['id','ground_truth','text','amr']].drop_duplicates()
     elif dataset in ['logic']:
-        df['text'] = df['input_json'].apply(lambda x: extract_value(x, 'source_article'))
+        df=df.assign(**extract_fields(df['input_json'],text='source_article'))
         df=df.merge(amr,how='inner',on='id')
     elif dataset in ['spider']:
-        df['text'] = df['input_json'].apply(lambda x: extract_value(x, 'question'))
+        df=df.assign(**extract_fields(df['input_json'],text='question'))
         df=df.merge(amr,how='inner',on='id')
     elif dataset in ['entity_recog']:
-        gold = pd.read_csv('../data/ldc_ner_features_true.csv')
-        gold = gold[['id','true_amr']]
+        gold = pd.read_csv('../data/ldc_ner_features_true.csv',usecols=['id','true_amr'])
         df=df.merge(gold,how='inner',on='id')
-        df['text'] = df['input_json'].apply(lambda x: extract_value(x, 'text'))
+        df=df.assign(**extract_fields(df['input_json'],text='text'))
         df=df.merge(amr,how='inner',on='id')
     elif dataset in ['newstest']:
-        df['text'] = df['input_json'].apply(lambda x: extract_value(x, 'en'))
-        df['ground_truth'] = df['input_json'].apply(lambda x: extract_value(x, 'de'))
+        df=df.assign(**extract_fields(df['input_json'],text='en',ground_truth='de'))
         amr['id']=amr['id'].str[:-3]
         df=df.merge(amr,how='inner',on='id')
     elif dataset in ['pubmed']:
-        df['text'] = df['input_json'].apply(lambda x: extract_value(x, 'sentence'))
-        df['interaction'] = df['input_json'].apply(lambda x: extract_value(x, 'interaction'))
+        df=df.assign(**extract_fields(df['input_json'],text='sentence',interaction='interaction'))
         df=df.merge(amr,how='inner',on='id')
     elif dataset in ['ldc_dev']:
         amr=amr.assign(id_type=np.where(amr.id.str.endswith('nonpara'),'nonpara',
@@ -176,13 +204,10 @@ def process_data(file_path,file_path_amr,dataset):
         
         amr_pivoted=pd.concat([amr_nonpara,amr_para])
         df=df.merge(amr_pivoted,how='inner',on='id')
-        df['premise'] = df['input_json'].apply(lambda x: extract_value(x, 'premise'))
-        df['hypothesis'] = df['input_json'].apply(lambda x: extract_value(x, 'hypothesis'))
+        df=df.assign(**extract_fields(df['input_json'],premise='premise',hypothesis='hypothesis'))
     elif dataset in ['slang']:
-        gold = pd.read_csv('../data/classifier_inputs/ldc_slang_hand.csv')
-        gold = gold[['id','true_premise_amr','hand_hypothesis_amr']]
-        df['premise'] = df['input_json'].apply(lambda x: extract_value2(x, 'premise'))
-        df['hypothesis'] = df['input_json'].apply(lambda x: extract_value2(x, 'hypothesis'))
+        gold = pd.read_csv('../data/classifier_inputs/ldc_slang_hand.csv',usecols=['id','true_premise_amr','hand_hypothesis_amr'])
+        df=df.assign(**extract_fields(df['input_json'],premise='premise',hypothesis='hypothesis'))
         amr_og=amr.loc[amr.id.str.endswith('og')]
         amr_og['id_m']=amr_og.id.str[:-3]
         amr_og=amr_og.loc[:,['id_m','amr']].rename(columns={'amr':'amr_p'})
@@ -194,6 +219,32 @@ def process_data(file_path,file_path_amr,dataset):
 
     return df
 
+# (phrase searched in the lowercased response, label); when several phrases occur the later entry wins
+logic_labels=[
+    ('faulty generalization','Faulty Generalization'),
+    ('false causality','False Causality'),
+    ('circular claim','Circular Reasoning'),
+    ('ad populum','Ad Populum'),
+    ('ad hominem','Ad Hominem'),
+    ('deductive fallacy','fallacy of logic'),
+    ('appeal to emotion','Appeal to Emotion'),
+    ('false dilemma','False Dilemma'),
+    ('equivocation','Equivocation'),
+    ('fallacy of extension','Fallacy of Extension'),
+    ('fallacy of relevance','Fallacy of Relevance'),
+    ('fallacy of credibility','Fallacy of Credibility'),
+    ('intentional fallacy','Intentional'),
+]
+
+def match_labels(responses,labels):
+    """Label each response by the last entry of `labels` whose phrase it contains, '' if none."""
+    by_priority=labels[::-1]
+    preds=[]
+    for response in responses:
+        text=response.lower() if isinstance(response,str) else ''
+        preds.append(next((label for phrase,label in by_priority if phrase in text),''))
+    return pd.Series(preds,index=responses.index)
+
 def process_response(df,dataset,amr_cot):
     if dataset in ['paws','ldc_dev','slang']:
         df['response_final'] = df['response']
@@ -206,20 +257,7 @@ def process_response(df,dataset,amr_cot):
     elif dataset in ['newstest','django','spider','entity_recog','pubmed']:
         df['pred'] = df['response']
     elif dataset in ['logic']:
-        df['pred']=''
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('faulty generalization'),'Faulty Generalization',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('false causality'),'False Causality',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('circular claim'),'Circular Reasoning',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('ad populum'),'Ad Populum',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('ad hominem'),'Ad Hominem',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('deductive fallacy'),'fallacy of logic',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('appeal to emotion'),'Appeal to Emotion',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('false dilemma'),'False Dilemma',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('equivocation'),'Equivocation',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('fallacy of extension'),'Fallacy of Extension',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('fallacy of relevance'),'Fallacy of Relevance',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('fallacy of credibility'),'Fallacy of Credibility',df.pred))
-        df=df.assign(pred=np.where(df.response.str.lower().str.contains('intentional fallacy'),'Intentional',df.pred))
+        df['pred']=match_labels(df['response'],logic_labels)
         df['pred']=df['pred'].str.lower()
     return df
 def simple_evaluation(df,test_set_pattern):
@@ -240,22 +278,87 @@ def simple_evaluation_str(df,test_set_pattern):
     print(classification_report(df.ground_truth,df.pred))
     return df
 
-def bleu_evaluation(df,test_set_pattern):
-    df['bleu']=0
+#################### BLEU ####################
+# list_bleu ran detokenizer.perl and then multi-bleu-detok.perl (mteval 13a tokenization) per sentence
+_detokenizer=MosesDetokenizer(lang='en')
+_bleu_tokenize_patterns=[
+    (re.compile(r'([\{-\~\[-\` -\&\(-\+\:-\@\/])'),r' \1 '),
+    (re.compile(r'([^0-9])([\.,])'),r'\1 \2 '),
+    (re.compile(r'([\.,])([^0-9])'),r' \1 \2'),
+    (re.compile(r'([0-9])(-)'),r'\1 \2 '),
+]
+
+def bleu_tokenize(text):
+    text=_detokenizer.detokenize(text.split())
+    text=text.replace('<skipped>','').replace('-\n','').replace('\n',' ')
+    if '&' in text:
+        text=text.replace('&quot;','"').replace('&amp;','&').replace('&lt;','<').replace('&gt;','>')
+    text=' '+text+' '
+    for pattern,repl in _bleu_tokenize_patterns:
+        text=pattern.sub(repl,text)
+    return text.split()
+
+def bleu_stats(hypothesis,reference,max_n=4):
+    """[hyp length, ref length, matches 1..max_n, totals 1..max_n] for one sentence pair."""
+    hyp=bleu_tokenize(hypothesis)
+    ref=bleu_tokenize(reference)
+    stats=[len(hyp),len(ref)]
+    matches=[]
+    totals=[]
+    for n in range(1,max_n+1):
+        hyp_ngrams=Counter(tuple(hyp[i:i+n]) for i in range(len(hyp)-n+1))
+        ref_ngrams=Counter(tuple(ref[i:i+n]) for i in range(len(ref)-n+1))
+        matches.append(sum((hyp_ngrams&ref_ngrams).values()))
+        totals.append(max(len(hyp)-n+1,0))
+    return stats+matches+totals
+
+def bleu_from_stats(stats,max_n=4):
+    """BLEU (0-100) as multi-bleu.perl computes it: no smoothing, any empty n-gram precision gives 0."""
+    hyp_len,ref_len=stats[0],stats[1]
+    matches=stats[2:2+max_n]
+    totals=stats[2+max_n:]
+    if hyp_len==0 or min(matches)==0:
+        return 0.0
+    log_precision=sum(math.log(m/t) for m,t in zip(matches,totals))/max_n
+    brevity=min(0.0,1-ref_len/hyp_len)
+    return 100*math.exp(brevity+log_precision)
+
+def _bleu_stats_chunk(pairs):
+    return [bleu_stats(h,r) for h,r in pairs]
+
+def bleu_scores(hypotheses,references,n_jobs=1,chunk_size=1000):
+    """Sentence BLEU for every pair, plus the per-pair statistics that corpus_bleu sums.
+
+    Statistics are computed in n_jobs processes when n_jobs>1.
+    """
+    pairs=list(zip(hypotheses,references))
+    chunks=[pairs[i:i+chunk_size] for i in range(0,len(pairs),chunk_size)]
+    if n_jobs==1 or len(chunks)<=1:
+        stats=_bleu_stats_chunk(pairs)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            stats=[s for chunk in executor.map(_bleu_stats_chunk,chunks) for s in chunk]
+    # list_bleu reported scores with two decimals
+    return [round(bleu_from_stats(s),2) for s in stats],stats
+
+def corpus_bleu(stats):
+    return bleu_from_stats([sum(column) for column in zip(*stats)]) if stats else 0.0
+
+def bleu_evaluation(df,test_set_pattern,n_jobs=1):
     df=df.loc[df.pred!='']
-    df=df.loc[~df.pred.isna()]
-    for i,d in df.iterrows():
-        score=0
-        answer=d['pred'].replace("\n","\\n")
-        score =list_bleu([[d['ground_truth']]], [answer])
-        df.at[i,'bleu']=score
-    df_test=df.loc[df.id.str.contains(test_set_pattern)]
+    df=df.loc[~df.pred.isna()].copy()
+    answers=df['pred'].str.replace("\n","\\n",regex=False)
+    df['bleu'],stats=bleu_scores(answers.tolist(),df['ground_truth'].astype(str).tolist(),n_jobs=n_jobs)
+    test_mask=df.id.str.contains(test_set_pattern)
+    df_test=df.loc[test_mask]
     print("Data points: ",df_test.shape[0])
     print("Avg BLEU:",df_test.bleu.mean())
+    print("Corpus BLEU:",corpus_bleu([s for s,m in zip(stats,test_mask) if m]))
     return df
+_enamex_pattern=re.compile(r'<ENAMEX TYPE="([^"]*)">([^<]*)</ENAMEX>')
+
 def extract_entities(text):
-    entity_pattern = r'<ENAMEX TYPE="([^"]*)">([^<]*)</ENAMEX>'
-    entities = re.findall(entity_pattern, text)
+    entities = _enamex_pattern.findall(text)
     entity_dict = {}
     for entity_type, entity_value in entities:
         if entity_type in entity_dict:
@@ -263,43 +366,354 @@ def extract_entities(text):
         else:
             entity_dict[entity_type] = [entity_value]
     return entity_dict
-def ner_evaluation(df,test_set_pattern):
-    gt=pd.read_csv("./data/classifier_inputs/ldc_ner_to_classifier.csv")
-    gt['labels'] = gt['input_json'].apply(lambda x: extract_value(x, 'tok_labeled'))
-    gt=gt.loc[:,['id','labels']]
-    df=df.merge(gt,on='id')
-    df=df.loc[~df.pred.isna()]
-    df=df.loc[df.pred!='']
-    # Apply the function to the dataframe column
-    df['entities'] = df['labels'].apply(extract_entities)
-    df['pred'] = df['pred'].apply(ast.literal_eval)
-    df['f1']=0
-    for i,row in df.iterrows():
-        ground_truth = row['entities']
-        prediction = row['pred']
-    
-        ground_truth_set = set((entity_type, entity_value) for entity_type, entity_values in ground_truth.items() for entity_value in entity_values)
-        prediction_set = set((entity_type, entity_value) for entity_type, entity_values in prediction.items() for entity_value in entity_values)
-        if len(prediction_set)==0 or len(ground_truth_set)==0:
-            #print(prediction_set)
-            #print(ground_truth_set)
-            f1=0
-            df.at[i,'f1']=f1
+
+def entity_set(entities):
+    """{type: [values]} -> set of (type, value).
+
+    A bare value counts as one entity and non-string values are compared as str() ({"CARDINAL": [3]} matches gold "3");
+    only None is dropped.
+    """
+    if not isinstance(entities,dict):
+        return frozenset()
+    pairs=set()
+    for entity_type,values in entities.items():
+        if not isinstance(values,(list,tuple,set)):
+            values=[values]
+        pairs.update((entity_type,str(v)) for v in values if v is not None)
+    return frozenset(pairs)
+
+_ner_gold_cache={}
+
+def load_ner_gold(path):
+    """id -> (tok_labeled text, gold (type, value) entities in order), parsed once per gold file version."""
+    key=(os.path.abspath(path),os.path.getmtime(path))
+    if key not in _ner_gold_cache:
+        gt=pd.read_csv(path,usecols=['id','input_json'])
+        labels=[(parse_structured(x) or {}).get('tok_labeled') for x in gt['input_json']]
+        _ner_gold_cache[key]=dict(zip(gt['id'],((l,tuple(_enamex_pattern.findall(l))) if isinstance(l,str) else (l,())
+                                                for l in labels)))
+    return _ner_gold_cache[key]
+
+def prf(tp,fp,fn):
+    precision=tp/(tp+fp) if tp+fp else 0.0
+    recall=tp/(tp+fn) if tp+fn else 0.0
+    f1=2*precision*recall/(precision+recall) if precision+recall else 0.0
+    return precision,recall,f1
+
+def ner_scores(gold_sets,pred_sets):
+    """Per-row precision/recall/F1 plus micro P/R/F1 over all entities and macro P/R/F1 averaged over entity types.
+
+    A row with no gold or no predicted entities scores 0.
+    """
+    rows=[]
+    counts={}
+    for gold,pred in zip(gold_sets,pred_sets):
+        # tp, fp, fn per entity type
+        for k,pairs in enumerate((gold&pred,pred-gold,gold-pred)):
+            for entity_type,_ in pairs:
+                counts.setdefault(entity_type,[0,0,0])[k]+=1
+        if not gold or not pred:
+            rows.append((0.0,0.0,0.0))
             continue
-        true_positives = len(ground_truth_set.intersection(prediction_set))
-        false_positives = len(prediction_set - ground_truth_set)
-        false_negatives = len(ground_truth_set - prediction_set)
-        
-        precision = true_positives / (true_positives + false_positives)
-        recall = true_positives / (true_positives + false_negatives)
-        f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-        df.at[i,'f1']=f1
-    df_test=df.loc[df.id.str.contains(test_set_pattern)]
+        tp=len(gold&pred)
+        rows.append(prf(tp,len(pred)-tp,len(gold)-tp))
+    scores=pd.DataFrame(rows,columns=['precision','recall','f1'])
+    micro=prf(*(sum(c[k] for c in counts.values()) for k in range(3)))
+    per_type={entity_type:prf(*c) for entity_type,c in counts.items()}
+    macro=tuple(np.mean(list(per_type.values()),axis=0)) if per_type else (0.0,0.0,0.0)
+    return scores,{'micro':micro,'macro':macro}
+
+def ner_evaluation(df,test_set_pattern,gold_file="./data/classifier_inputs/ldc_ner_to_classifier.csv"):
+    gold=load_ner_gold(gold_file)
+    df=df.loc[df.id.isin(gold)]
+    df=df.loc[~df.pred.isna()]
+    df=df.loc[df.pred!=''].copy()
+    gold_rows=[gold[i] for i in df['id']]
+    gold_sets=[frozenset(entities) for _,entities in gold_rows]
+    parsed=[parse_structured(p) for p in df['pred']]
+    pred_sets=[entity_set(p) for p in parsed]
+    # same columns as the final_results_ner files: gold text and entities, pred decoded
+    df['labels']=[l for l,_ in gold_rows]
+    df['entities']=[extract_entities(l) if isinstance(l,str) else {} for l,_ in gold_rows]
+    df['pred']=[p if p is not None else raw for p,raw in zip(parsed,df['pred'])]
+    scores,_=ner_scores(gold_sets,pred_sets)
+    df[['precision','recall','f1']]=scores.values
+    test_mask=df.id.str.contains(test_set_pattern)
+    df_test=df.loc[test_mask]
+    _,summary=ner_scores([g for g,m in zip(gold_sets,test_mask) if m],[p for p,m in zip(pred_sets,test_mask) if m])
     print("Data points: ",df_test.shape[0])
     print("Avg F1:",df_test.f1.mean())
+    for average,(p,r,f1) in summary.items():
+        print(average,"P/R/F1:",round(p,4),round(r,4),round(f1,4))
     return df
 
-def main(file_path,file_path_amr,dataset,amr_cot):
+#################### concurrent requests ####################
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token) used for rate limiting."""
+    return len(text)//4+1
+
+class RateLimiter:
+    """Sliding one-minute window over requests and prompt tokens."""
+    def __init__(self,requests_per_minute=None,tokens_per_minute=None):
+        self.requests_per_minute=requests_per_minute
+        self.tokens_per_minute=tokens_per_minute
+        self.window=deque()
+        self.tokens=0
+        self.lock=asyncio.Lock()
+
+    def _fits(self,tokens):
+        if self.requests_per_minute and len(self.window)>=self.requests_per_minute:
+            return False
+        if self.tokens_per_minute and self.window and self.tokens+tokens>self.tokens_per_minute:
+            return False
+        return True
+
+    async def acquire(self,tokens):
+        async with self.lock:
+            while True:
+                now=time.monotonic()
+                while self.window and now-self.window[0][0]>=60:
+                    self.tokens-=self.window.popleft()[1]
+                if self._fits(tokens):
+                    self.window.append((now,tokens))
+                    self.tokens+=tokens
+                    return
+                await asyncio.sleep(60-(now-self.window[0][0]))
+
+async def request_with_retry(send,message,limiter=None,max_retries=5,backoff=1.0):
+    """Await send(message), retrying failures with jittered exponential backoff. Returns None once retries are exhausted."""
+    for attempt in range(max_retries+1):
+        if limiter is not None:
+            await limiter.acquire(estimate_tokens(message))
+        try:
+            return await send(message)
+        except Exception as e:
+            if attempt==max_retries:
+                print("request failed after",attempt+1,"attempts:",repr(e))
+                return None
+            await asyncio.sleep(backoff*2**attempt*(1+random.random()))
+
+async def run_requests(send,messages,concurrency=8,requests_per_minute=None,tokens_per_minute=None,
+                       max_retries=5,backoff=1.0,on_result=None):
+    """Send all messages with at most `concurrency` requests in flight.
+
+    Responses are returned in input order; on_result(position, response) is called as each one completes.
+    """
+    semaphore=asyncio.Semaphore(concurrency)
+    limiter=RateLimiter(requests_per_minute,tokens_per_minute)
+
+    async def worker(position,message):
+        async with semaphore:
+            response=await request_with_retry(send,message,limiter,max_retries,backoff)
+        if on_result is not None:
+            on_result(position,response)
+        return response
+
+    return await asyncio.gather(*(worker(position,m) for position,m in enumerate(messages)))
+
+#################### result journal ####################
+def journal_path(output_file):
+    return os.path.splitext(output_file)[0]+'.jsonl'
+
+def read_journal(path):
+    """Responses recorded in an append-only journal, keyed by id. A line cut short by a crash is ignored."""
+    responses={}
+    if not os.path.exists(path):
+        return responses
+    with open(path) as f:
+        for line in f:
+            try:
+                record=json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            responses[record['id']]=record['response']
+    return responses
+
+def append_journal(journal,row_id,response):
+    journal.write(json.dumps({"id":row_id,"response":response})+'\n')
+    journal.flush()
+
+#################### response cache ####################
+class ResponseCache:
+    """On-disk response cache addressed by a hash of (model, temperature, system prompt, message).
+
+    Entries are single JSON files; prune() drops the least recently used ones once the cache exceeds max_bytes.
+    """
+    def __init__(self,cache_dir,model_name,temperature,system_prompt,max_bytes=1<<30):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.prefix=json.dumps([model_name,temperature,system_prompt])
+        self.hits=0
+        self.misses=0
+
+    def path(self,message):
+        key=hashlib.sha256((self.prefix+'\0'+message).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir,key[:2],key+'.json')
+
+    def get(self,message):
+        path=self.path(message)
+        try:
+            with open(path) as f:
+                response=json.load(f)['response']
+        except (OSError,ValueError,KeyError):
+            self.misses+=1
+            return None
+        os.utime(path)
+        self.hits+=1
+        return response
+
+    def put(self,message,response):
+        path=self.path(message)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tmp=path+'.'+str(os.getpid())+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump({'response':response},f)
+        os.replace(tmp,path)
+
+    def entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [e for d in os.scandir(self.cache_dir) if d.is_dir() for e in os.scandir(d.path) if e.name.endswith('.json')]
+
+    def prune(self):
+        entries=sorted(((e.stat().st_mtime,e.stat().st_size,e.path) for e in self.entries()),reverse=True)
+        total=0
+        for _,size,path in entries:
+            total+=size
+            if total>self.max_bytes:
+                os.remove(path)
+
+    def report(self):
+        lookups=self.hits+self.misses
+        entries=self.entries()
+        print("Response cache: hits",self.hits,"misses",self.misses,
+              "hit rate",round(self.hits/lookups,3) if lookups else 0,
+              "entries",len(entries),"size",round(sum(e.stat().st_size for e in entries)/2**20,1),"MB")
+
+#################### stateless request path ####################
+def render_prompts(df,prompt,dataset):
+    """Format the user message of every row in one pass over the prompt columns."""
+    fields=prompt_fields[dataset]
+    keys=list(fields)
+    rows=zip(*(df[c].tolist() for c in fields.values()))
+    return [prompt.format(**dict(zip(keys,values))) for values in rows]
+
+def chat_messages(system_prompt,m1):
+    return [SystemMessage(content=system_prompt),HumanMessage(content=m1)]
+
+def benchmark_request_path(dataset='logic',amr_cot=True,n=2000,repeat=3):
+    """Per-row cost of preparing a request (no network): ConversationChain per row vs the stateless path."""
+    prompt=prompts_dict[dataset]['amr_prompt' if amr_cot else 'single_prompt']
+    system_prompt=prompts_dict[dataset]['system_prompt']
+    df=pd.DataFrame({c:[c+' '+str(i) for i in range(n)] for c in prompt_fields[dataset].values()})
+    llm=ChatOpenAI(temperature=0,model_name="gpt-3.5-turbo-16k-0613",openai_api_key='benchmark')
+    sys_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(system_prompt),
+        MessagesPlaceholder(variable_name="history"),
+        HumanMessagePromptTemplate.from_template('{input}')
+    ])
+
+    def chain_path():
+        for i,d in df.iterrows():
+            memory = ConversationBufferMemory(return_messages=True)
+            conversation = ConversationChain(memory=memory, prompt=sys_prompt, llm=llm)
+            m1=prompt.format(**{k:d[c] for k,c in prompt_fields[dataset].items()})
+            conversation.prompt.format_prompt(input=m1,**memory.load_memory_variables({})).to_messages()
+
+    def stateless_path():
+        [chat_messages(system_prompt,m1) for m1 in render_prompts(df,prompt,dataset)]
+
+    old=min(timeit.repeat(chain_path,number=1,repeat=repeat))
+    new=min(timeit.repeat(stateless_path,number=1,repeat=repeat))
+    print("ConversationChain per row: ",round(old/n*1e6,1),"us/row")
+    print("stateless:                 ",round(new/n*1e6,1),"us/row")
+    print("speedup:",round(old/new,1),"x")
+
+#################### batch api ####################
+BATCH_DONE=['completed','failed','expired','cancelled']
+
+def build_batch_file(path,ids,messages,system_prompt,model_name,temperature):
+    """Write one chat-completions request per row, with the row id as custom_id."""
+    with open(path,'w') as f:
+        for row_id,m1 in zip(ids,messages):
+            body={'model':model_name,'temperature':temperature,
+                  'messages':[{'role':'system','content':system_prompt},{'role':'user','content':m1}]}
+            f.write(json.dumps({'custom_id':row_id,'method':'POST','url':'/v1/chat/completions','body':body})+'\n')
+
+def api_request(api_base,method,path,body=None,content_type='application/json'):
+    headers={'Authorization':'Bearer '+os.environ.get('OPENAI_API_KEY','')}
+    if body is not None:
+        headers['Content-Type']=content_type
+        if content_type=='application/json':
+            body=json.dumps(body).encode('utf-8')
+    request=urllib.request.Request(api_base.rstrip('/')+path,data=body,headers=headers,method=method)
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+def upload_batch_file(api_base,path):
+    boundary=uuid.uuid4().hex
+    with open(path,'rb') as f:
+        content=f.read()
+    body=(('--'+boundary+'\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+           '--'+boundary+'\r\nContent-Disposition: form-data; name="file"; filename="'+os.path.basename(path)+'"\r\n'
+           'Content-Type: application/jsonl\r\n\r\n').encode('utf-8')+content+('\r\n--'+boundary+'--\r\n').encode('utf-8'))
+    uploaded=api_request(api_base,'POST','/files',body,'multipart/form-data; boundary='+boundary)
+    return json.loads(uploaded)['id']
+
+def submit_batch(api_base,path):
+    file_id=upload_batch_file(api_base,path)
+    batch=api_request(api_base,'POST','/batches',{'input_file_id':file_id,'endpoint':'/v1/chat/completions',
+                                                  'completion_window':'24h'})
+    return json.loads(batch)['id']
+
+def wait_for_batch(api_base,batch_id,poll_interval=60):
+    while True:
+        batch=json.loads(api_request(api_base,'GET','/batches/'+batch_id))
+        print("batch",batch_id,batch['status'],batch.get('request_counts',''))
+        if batch['status'] in BATCH_DONE:
+            return batch
+        time.sleep(poll_interval)
+
+def read_batch_results(content):
+    """Map custom_id -> response text for the successful lines of a batch output file."""
+    results={}
+    for line in content.decode('utf-8').splitlines():
+        if not line.strip():
+            continue
+        record=json.loads(line)
+        response=record.get('response') or {}
+        if response.get('status_code')==200:
+            results[record['custom_id']]=response['body']['choices'][0]['message']['content']
+    return results
+
+def run_batch(api_base,batch_file,ids,messages,system_prompt,model_name,temperature,poll_interval=60):
+    """Submit messages as one batch job, wait for it and return its responses keyed by id.
+
+    The batch id is kept next to batch_file so an interrupted run polls the same job instead of submitting again.
+    """
+    state_file=batch_file+'.id'
+    if not ids and not os.path.exists(state_file):
+        return {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            batch_id=f.read().strip()
+        print("Polling existing batch",batch_id)
+    else:
+        build_batch_file(batch_file,ids,messages,system_prompt,model_name,temperature)
+        batch_id=submit_batch(api_base,batch_file)
+        with open(state_file,'w') as f:
+            f.write(batch_id)
+    batch=wait_for_batch(api_base,batch_id,poll_interval)
+    results={}
+    if batch.get('output_file_id'):
+        results=read_batch_results(api_request(api_base,'GET','/files/'+batch['output_file_id']+'/content'))
+    os.remove(state_file)
+    print("Batch",batch_id,batch['status'],":",len(results),"of",len(ids),"responses")
+    return results
+
+def main(file_path,file_path_amr,dataset,amr_cot,concurrency=8,requests_per_minute=3500,tokens_per_minute=180000,
+         max_retries=5,api_base=None,resume=True,cache_dir='../data/cache/llm_responses',cache_max_mb=1024,
+         batch=False,batch_poll_interval=60):
     ## parameters
     #dataset='logic'
     #all_datasets=['newstest','paws','django','logic','spider','entity_recog','pubmed','ldc_dev']
@@ -308,8 +722,15 @@ def main(file_path,file_path_amr,dataset,amr_cot):
     #file_path_amr="./corrected_amrs.csv"
 
     ## setup chat
-    llm = ChatOpenAI(temperature=0,model_name="gpt-3.5-turbo-16k-0613")
+    # retries are handled by run_requests
+    llm_kwargs={} if api_base is None else {'openai_api_base':api_base}
+    model_name="gpt-3.5-turbo-16k-0613"
+    temperature=0
+    llm = ChatOpenAI(temperature=temperature,model_name=model_name,max_retries=1,**llm_kwargs)
     system_prompt = prompts_dict[dataset]['system_prompt']
+    cache=None
+    if cache_dir:
+        cache=ResponseCache(cache_dir,model_name,temperature,system_prompt,max_bytes=cache_max_mb*2**20)
     if amr_cot:
         prompt=prompts_dict[dataset]['amr_prompt']
     else:
@@ -317,40 +738,66 @@ def main(file_path,file_path_amr,dataset,amr_cot):
 
     df=process_data(file_path,file_path_amr,dataset)
 
-    sys_prompt = ChatPromptTemplate.from_messages([
-        SystemMessagePromptTemplate.from_template(
-            system_prompt
-        ),
-        MessagesPlaceholder(variable_name="history"),
-        HumanMessagePromptTemplate.from_template('{input}')
-    ])
-
     ## requests
-    df['response']=''
     if amr_cot:
         output_file="../data/outputs/requests_amr_"+dataset+"_true.csv"
     else:
         output_file="../data/outputs/requests_direct_"+dataset+".csv"
-    for i,d in df.iterrows():
-        memory = ConversationBufferMemory(return_messages=True)
-        conversation = ConversationChain(memory=memory, prompt=sys_prompt, llm=llm)
-        if dataset in ['slang']:
-            m1 = prompt.format(sentence_1=d['premise'], amr_1=d['true_premise_amr'], sentence_2=d['hypothesis'], amr_2=d['hand_hypothesis_amr'])
-        elif dataset in ['entity_recog']:
-            m1 = prompt.format(sentence_1=d['text'], amr_1=d['true_amr'])
-        elif dataset in ['paws','ldc_dev','slang']:
-            m1 = prompt.format(sentence_1=d['premise'],amr_1=d['amr_p'],sentence_2=d['hypothesis'],amr_2=d['amr_h'])
-        elif dataset in ['newstest','logic','django','spider','entity_recog']:
-            m1 = prompt.format(sentence_1=d['text'],amr_1=d['amr'])
-        elif dataset in ['pubmed']:
-            m1 = prompt.format(sentence_1=d['text'],amr_1=d['amr'],interaction=str(d['interaction']))
-        df.at[i, 'response'] =conversation.predict(input=m1)
-        history = memory.chat_memory.messages
-        if i%50==0:
-            print(i)
-            print(d['id'],"gt:",d['ground_truth'],"#### pred: ",history[-1].content)
-            df.to_csv(output_file,index=False)
+    journal_file=journal_path(output_file)
+    responses=read_journal(journal_file) if resume else {}
+    if responses:
+        print("Resuming:",len(responses),"responses already in",journal_file)
+    pending=df.loc[~df.id.isin(responses)]
+    messages=render_prompts(pending,prompt,dataset)
+
+    async def send(m1):
+        response=await llm.apredict_messages(chat_messages(system_prompt,m1))
+        return response.content
 
+    done=[0]
+    def on_result(position,response):
+        d=pending.iloc[position]
+        # failed requests stay out of the journal so a resumed run retries them
+        if response is not None:
+            responses[d['id']]=response
+            append_journal(journal,d['id'],response)
+            if cache is not None:
+                cache.put(messages[position],response)
+        done[0]+=1
+        if done[0]%50==0:
+            print(done[0])
+            print(d['id'],"gt:",d['ground_truth'],"#### pred: ",response)
+
+    start=time.time()
+    with open(journal_file,'a' if resume else 'w') as journal:
+        if cache is not None:
+            keep=[]
+            for position,m1 in enumerate(messages):
+                response=cache.get(m1)
+                if response is None:
+                    keep.append(position)
+                else:
+                    row_id=pending['id'].iloc[position]
+                    responses[row_id]=response
+                    append_journal(journal,row_id,response)
+            pending=pending.iloc[keep]
+            messages=[messages[position] for position in keep]
+        if batch and len(pending):
+            unique=~pending.id.duplicated()
+            results=run_batch(api_base or os.environ.get('OPENAI_API_BASE','https://api.openai.com/v1'),
+                              os.path.splitext(output_file)[0]+'_batch.jsonl',
+                              pending.id[unique].tolist(),[m1 for m1,u in zip(messages,unique) if u],
+                              system_prompt,model_name,temperature,batch_poll_interval)
+            for position,row_id in enumerate(pending['id']):
+                on_result(position,results.get(row_id))
+        else:
+            asyncio.run(run_requests(send,messages,concurrency=concurrency,requests_per_minute=requests_per_minute,
+                                     tokens_per_minute=tokens_per_minute,max_retries=max_retries,on_result=on_result))
+    print("Requests:",len(messages),"in",round(time.time()-start,1),"s")
+    if cache is not None:
+        cache.prune()
+        cache.report()
+    df['response']=df['id'].map(responses).fillna('')
 
     ## parse response and results
     df=process_response(df,dataset,amr_cot)
@@ -369,7 +816,7 @@ def main(file_path,file_path_amr,dataset,amr_cot):
     elif dataset in ['newstest']:
         df=bleu_evaluation(df,'newstest16')
     elif dataset in ['django']:
-        df=bleu_evaluation(df,'test')
+        df=bleu_evaluation(df,'test',n_jobs=os.cpu_count())
     elif dataset in ['entity_recog']:
         df=ner_evaluation(df,'entity_recog')
 
@@ -384,7 +831,20 @@ if __name__ == '__main__':
     parser.add_argument('--data_file', type=str, default="./updated_data_input - classifier_input.csv", help='the csv file')
     parser.add_argument('--amr_file', type=str, default='./corrected_amrs.csv',  help='the amr csv file')
     parser.add_argument('--dataset', type=str, default='logic', help='the dataset name')
+    parser.add_argument('--concurrency', type=int, default=8, help='maximum number of requests in flight')
+    parser.add_argument('--rpm', type=int, default=3500, help='requests per minute limit')
+    parser.add_argument('--tpm', type=int, default=180000, help='prompt tokens per minute limit')
+    parser.add_argument('--max_retries', type=int, default=5, help='retries per request before giving up')
+    parser.add_argument('--api_base', type=str, default=None, help='chat completions base url, e.g. a local mock server')
+    parser.add_argument('--fresh', action='store_true', help='ignore the response journal of a previous run')
+    parser.add_argument('--cache_dir', type=str, default='../data/cache/llm_responses', help='response cache directory, empty to disable')
+    parser.add_argument('--cache_max_mb', type=int, default=1024, help='response cache size limit in MB')
+    parser.add_argument('--batch', action='store_true', help='submit all prompts as one batch api job instead of live requests')
+    parser.add_argument('--batch_poll_interval', type=int, default=60, help='seconds between batch status checks')
     amr_cot=False
     args = parser.parse_args()
     # main(args.data_file, args.amr_file,args.dataset,amr_cot)
-    main(data_file, amr_file, dataset, amr_cot)
\ No newline at end of file
+    main(data_file, amr_file, dataset, amr_cot, concurrency=args.concurrency, requests_per_minute=args.rpm,
+         tokens_per_minute=args.tpm, max_retries=args.max_retries, api_base=args.api_base,
+         resume=not args.fresh, cache_dir=args.cache_dir, cache_max_mb=args.cache_max_mb,
+         batch=args.batch, batch_poll_interval=args.batch_poll_interval)
\ No newline at end of file
@@ -1,6 +1,10 @@
 import argparse
 import csv
+import multiprocessing
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from transition_amr_parser.parse import AMRParser
 
@@ -8,30 +12,193 @@ from transition_amr_parser.parse import AMRParser
 #os.environ["TORCH_HOME"] = "/tmp"
 
 
-def main(input_file, output_file,model):
-    parser = AMRParser.from_pretrained(model)
-    df=pd.read_csv(input_file)
-    for i in range(0,df.shape[0],1):
-        data=list(df['text_detok'].values)[i]
-        idx=list(df['id'].values)[i]
-        tokens, positions = parser.tokenize(data)
+class BufferedRowWriter:
+    """csv writer kept open for the whole run; rows are flushed to disk every flush_rows rows or flush_seconds seconds."""
+    def __init__(self, path, flush_rows=100, flush_seconds=30):
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def write(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.flush_rows or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        self.file.flush()
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def failure_log_path(output_file):
+    return os.path.splitext(output_file)[0] + '_failed.csv'
+
+def written_ids(output_file):
+    """ids already in an output file (rows are id, text, amr without a header)."""
+    if not os.path.exists(output_file):
+        return set()
+    with open(output_file, newline='') as f:
+        return {row[0] for row in csv.reader(f) if row}
+
+def to_penman(machine):
+    amr = machine.get_amr()
+    return amr.to_penman(jamr=False, isi=True)
+
+def parse_batch(parser, batch_tokens):
+    """Penman strings for a batch of tokenized sentences, an Exception in place of any sentence that failed.
+    If the batched call itself fails the sentences are parsed one by one."""
+    try:
+        annotations, machines = parser.parse_sentences(batch_tokens, batch_size=len(batch_tokens))
+    except Exception:
+        machines = []
+        for tokens in batch_tokens:
+            try:
+                annotations, machine = parser.parse_sentence(tokens)
+                machines.append(machine)
+            except Exception as e:
+                machines.append(e)
+    results = []
+    for machine in machines:
         try:
-            annotations, machines = parser.parse_sentence(tokens)
-            amr = machines.get_amr()
-            res=amr.to_penman(jamr=False, isi=True)
-            with open(output_file, 'a') as csvoutput:
-                writer = csv.writer(csvoutput, lineterminator='\n')
-                writer.writerow([idx,data,res])
-            if i%100==0:
-                print(f'Finished {i} sentences', flush = True)
+            results.append(machine if isinstance(machine, Exception) else to_penman(machine))
         except Exception as e:
-            print(e)
-            continue
+            results.append(e)
+    return results
+
+def parse_window(parser, sentences, batch_size):
+    """Parse sentences in length-sorted batches and return the results in input order."""
+    tokenized = [parser.tokenize(s)[0] for s in sentences]
+    order = sorted(range(len(sentences)), key=lambda i: len(tokenized[i]))
+    results = [None] * len(sentences)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        for i, res in zip(batch, parse_batch(parser, [tokenized[i] for i in batch])):
+            results[i] = res
+    return results
+
+def parse_rows(parser, df, output_file, batch_size, sort_window, resume, flush_rows, flush_seconds, name=''):
+    """Parse the text_detok column of df, appending (id, text, amr) rows to output_file."""
+    if resume:
+        done=written_ids(output_file)
+        print(f'{name}Resuming: skipping {len(done)} sentences already in {output_file}', flush = True)
+        df=df.loc[~df['id'].astype(str).isin(done)]
+    texts=df['text_detok'].tolist()
+    ids=df['id'].tolist()
+    start_time=time.time()
+    parsed=0
+    with BufferedRowWriter(output_file, flush_rows, flush_seconds) as writer, \
+         BufferedRowWriter(failure_log_path(output_file), flush_rows, flush_seconds) as failures:
+        # sentences are length-sorted within windows of sort_window so rows are still written in input order
+        for w in range(0, len(texts), sort_window):
+            window=texts[w:w + sort_window]
+            results=parse_window(parser, window, batch_size)
+            for idx, data, res in zip(ids[w:w + sort_window], window, results):
+                if isinstance(res, Exception):
+                    print(idx, res)
+                    failures.write([idx, data, repr(res)])
+                    continue
+                writer.write([idx,data,res])
+            parsed+=len(window)
+            elapsed=time.time()-start_time
+            print(f'{name}Finished {parsed} sentences, {parsed/elapsed:.2f} sentences/sec', flush = True)
+    return parsed
+
+def shard_path(output_file, shard):
+    root, ext = os.path.splitext(output_file)
+    return f'{root}.shard{shard}{ext}'
+
+def shard_layout_path(output_file):
+    return os.path.splitext(output_file)[0] + '.shards'
+
+def prepare_shards(output_file, workers, resume):
+    """Number of shards to run. A resumed run keeps the shard count recorded by the run it resumes, so the input
+    is sliced the same way; a fresh run empties the shard outputs and failure logs of an earlier run."""
+    layout_file = shard_layout_path(output_file)
+    if resume and os.path.exists(layout_file):
+        with open(layout_file) as f:
+            recorded = int(f.read())
+        if recorded != workers:
+            print(f'Resuming the {recorded} shards of the previous run instead of {workers}', flush = True)
+        workers = recorded
+    if not resume:
+        for shard in range(workers):
+            for path in [shard_path(output_file, shard), failure_log_path(shard_path(output_file, shard))]:
+                if os.path.exists(path):
+                    os.remove(path)
+    with open(layout_file, 'w') as f:
+        f.write(str(workers))
+    return workers
+
+def parse_shard(input_file, output_file, model, shard, n_shards, threads, batch_size, sort_window, resume,
+                flush_rows, flush_seconds):
+    """Worker: load the model once and parse the shard-th contiguous slice of the input."""
+    import torch
+    torch.set_num_threads(threads)
+    parser = AMRParser.from_pretrained(model)
+    df=pd.read_csv(input_file)
+    bounds=[len(df) * k // n_shards for k in range(n_shards + 1)]
+    df=df.iloc[bounds[shard]:bounds[shard + 1]]
+    return parse_rows(parser, df, shard_path(output_file, shard), batch_size, sort_window, resume,
+                      flush_rows, flush_seconds, name=f'[shard {shard}] ')
+
+def merge_shards(input_file, output_file, n_shards):
+    """Write the rows of all shard outputs to output_file in input order."""
+    rows={}
+    for shard in range(n_shards):
+        with open(shard_path(output_file, shard), newline='') as f:
+            for row in csv.reader(f):
+                if row:
+                    rows.setdefault(row[0], deque()).append(row)
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for idx in pd.read_csv(input_file, usecols=['id'])['id'].astype(str):
+            if rows.get(idx):
+                writer.writerow(rows[idx].popleft())
+
+def main(input_file, output_file, model, batch_size=16, sort_window=1024, resume=False, flush_rows=100, flush_seconds=30,
+         workers=1, threads_per_worker=None):
+    if workers <= 1:
+        parser = AMRParser.from_pretrained(model)
+        parse_rows(parser, pd.read_csv(input_file), output_file, batch_size, sort_window, resume, flush_rows, flush_seconds)
+        return
+    workers = prepare_shards(output_file, workers, resume)
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    # children read these when torch is imported
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+    start_time=time.time()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures=[executor.submit(parse_shard, input_file, output_file, model, shard, workers, threads, batch_size,
+                                 sort_window, resume, flush_rows, flush_seconds) for shard in range(workers)]
+        parsed=sum(f.result() for f in futures)
+    print(f'Parsed {parsed} sentences with {workers} workers, {parsed/(time.time()-start_time):.2f} sentences/sec', flush = True)
+    merge_shards(input_file, output_file, workers)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Gets AMR from text')
     parser.add_argument('--input_file', type=str, default="../data/raw_files/ldc_slang_to_amr.csv", help='the input csv file')
     parser.add_argument('--output_file', type=str, default='../processed/AMR3-structbart-L_slang_output.csv',  help='the output csv file')
     parser.add_argument('--model', type=str, default='AMR3-structbart-L', help='the model name')
+    parser.add_argument('--batch_size', type=int, default=16, help='sentences per parser call')
+    parser.add_argument('--sort_window', type=int, default=1024, help='sentences sorted by length together before batching')
+    parser.add_argument('--resume', action='store_true', help='skip ids already written to the output file')
+    parser.add_argument('--flush_rows', type=int, default=100, help='flush the output every this many rows')
+    parser.add_argument('--flush_seconds', type=float, default=30, help='flush the output at least this often')
+    parser.add_argument('--workers', type=int, default=1, help='parser processes, each parsing one shard of the input')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='torch threads per worker (default: cores / workers)')
     args = parser.parse_args()
-    main(args.input_file, args.output_file,args.model)
+    main(args.input_file, args.output_file,args.model,args.batch_size,args.sort_window,args.resume,
+         args.flush_rows,args.flush_seconds,args.workers,args.threads_per_worker)
@@ -0,0 +1,50 @@
+import argparse
+import os
+import pandas as pd
+
+# class-label columns stored dictionary-encoded; free text and AMR columns stay plain strings
+LABEL_COLUMNS=['ground_truth','pred','pred_amr','label_direct','label_amr']
+
+
+def parquet_path(path):
+    return os.path.splitext(path)[0]+'.parquet'
+
+def convert_results(csv_path,output_path=None):
+    """Write a final_results csv as parquet next to it (typed columns, dictionary-encoded labels)."""
+    output_path=output_path or parquet_path(csv_path)
+    df=pd.read_csv(csv_path)
+    for c in LABEL_COLUMNS:
+        if c in df.columns and not pd.api.types.is_numeric_dtype(df[c]):
+            df[c]=df[c].astype('category')
+    df.to_parquet(output_path,index=False)
+    return output_path
+
+def load_results(path,columns=None):
+    """Load a results file, preferring an up-to-date parquet copy of a csv.
+
+    The parquet file is memory-mapped and only `columns` are read; columns missing from the file are skipped.
+    Falls back to the csv when there is no parquet copy, it is older than the csv, or pyarrow is not installed.
+    """
+    parquet=path if path.endswith('.parquet') else parquet_path(path)
+    if os.path.exists(parquet) and (not os.path.exists(path) or os.path.getmtime(parquet)>=os.path.getmtime(path)):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            pass
+        else:
+            if columns is not None:
+                available=set(pq.read_schema(parquet).names)
+                columns=[c for c in columns if c in available]
+            return pd.read_parquet(parquet,columns=columns,memory_map=True)
+    if columns is not None:
+        available=set(pd.read_csv(path,nrows=0).columns)
+        columns=[c for c in columns if c in available]
+    return pd.read_csv(path,usecols=columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert final results csv files to parquet')
+    parser.add_argument('files', nargs='+', help='the csv files')
+    args = parser.parse_args()
+    for f in args.files:
+        print(f,'->',convert_results(f))
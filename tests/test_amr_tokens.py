@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+repo_dir = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(repo_dir))
+
+import amr_score
+
+# per-row counts of nltk.word_tokenize(amr, preserve_line=True) (nltk 3.10) on the AMR columns of the shipped CSVs
+fixture = pd.read_csv(Path(__file__).parent / 'fixtures' / 'amr_token_counts.csv')
+
+
+@pytest.mark.parametrize('file', sorted(fixture['file'].unique()))
+def test_amr_token_counts_match_fixture(file):
+    expected = fixture.loc[fixture['file'] == file]
+    df = pd.read_csv(repo_dir / file, usecols=expected['column'].unique().tolist())
+    mismatches = [(column, row, tokens, amr_score.amr_tokens(df[column].iloc[row]))
+                  for column, row, tokens in zip(expected['column'], expected['row'], expected['tokens'])
+                  if amr_score.amr_tokens(df[column].iloc[row]) != tokens]
+    assert not mismatches
+
+
+@pytest.mark.parametrize('amr', [
+    '(s / say-01 :ARG0 (p / person :name (n / name :op1 "Mr." :op2 "Vinken")))',
+    '(c / city :wiki "Washington,_D.C." :quant 1,000)',
+    "(p / person :name (n / name :op1 \"O'Neil\" :op2 \"don't\" :op3 \"it's\"))",
+    '(w / want-01 :ARG1 (g / go-02 :mod "gonna" :op1 "cannot" :op2 "wanna"))',
+    '(a / and :op1 "..." :op2 "--" :op3 ``quote\'\' :op4 ```b :op5 "x::y")',
+    '(e / end-01 :ARG1 (t / thing :name "Inc."))).',
+    '(t / t :name "Co.") "',
+    'x. "',
+])
+def test_amr_tokenize_matches_nltk(amr):
+    nltk = pytest.importorskip('nltk')
+    # nltk rewrites double quotes as `` and '', amr_tokenize keeps them as '"'
+    quotes = {'``': '"', "''": '"'}
+    assert ([quotes.get(t, t) for t in amr_score.amr_tokenize(amr)]
+            == [quotes.get(t, t) for t in nltk.word_tokenize(amr, preserve_line=True)])
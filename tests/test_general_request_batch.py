@@ -0,0 +1,144 @@
+import json
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+repo_dir = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(repo_dir))
+
+general_request = pytest.importorskip('general_request')
+
+
+class FakeBatchAPI(BaseHTTPRequestHandler):
+    """The part of the OpenAI files/batches API that run_batch uses. A batch completes on its second poll and
+    answers every request with 'answer <custom_id>', except the custom_ids in failing, which get a 500."""
+    files = {}
+    batches = {}
+    failing = set()
+    submitted = []
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path == '/v1/files':
+            boundary = self.headers['Content-Type'].split('boundary=')[1].encode('utf-8')
+            part = [p for p in body.split(b'--' + boundary) if b'name="file"' in p][0]
+            self.reply({'id': add_file(part.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n', 1)[0])})
+        elif self.path == '/v1/batches':
+            batch_id = add_batch(json.loads(body)['input_file_id'])
+            FakeBatchAPI.submitted.append(batch_id)
+            self.reply({'id': batch_id, 'status': 'validating'})
+
+    def do_GET(self):
+        match = re.fullmatch(r'/v1/batches/([^/]+)', self.path)
+        if match:
+            batch = FakeBatchAPI.batches[match.group(1)]
+            batch['polls'] += 1
+            if batch['polls'] < 2:
+                return self.reply({'id': match.group(1), 'status': 'in_progress'})
+            return self.reply({'id': match.group(1), 'status': 'completed', 'output_file_id': batch_output(batch)})
+        match = re.fullmatch(r'/v1/files/([^/]+)/content', self.path)
+        self.reply(FakeBatchAPI.files[match.group(1)])
+
+
+def add_file(content):
+    file_id = f'file-{len(FakeBatchAPI.files)}'
+    FakeBatchAPI.files[file_id] = content
+    return file_id
+
+
+def add_batch(input_file_id):
+    batch_id = f'batch-{len(FakeBatchAPI.batches)}'
+    FakeBatchAPI.batches[batch_id] = {'input': input_file_id, 'polls': 0}
+    return batch_id
+
+
+def custom_ids(file_id):
+    return [json.loads(line)['custom_id'] for line in FakeBatchAPI.files[file_id].splitlines()]
+
+
+def batch_output(batch):
+    lines = []
+    for custom_id in custom_ids(batch['input']):
+        if custom_id in FakeBatchAPI.failing:
+            lines.append({'custom_id': custom_id, 'response': {'status_code': 500, 'body': {}}})
+        else:
+            lines.append({'custom_id': custom_id, 'response': {'status_code': 200, 'body': {
+                'choices': [{'message': {'content': 'answer ' + custom_id}}]}}})
+    return add_file('\n'.join(json.dumps(line) for line in lines).encode('utf-8'))
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    FakeBatchAPI.files = {}
+    FakeBatchAPI.batches = {}
+    FakeBatchAPI.failing = set()
+    FakeBatchAPI.submitted = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBatchAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    ids = [f'logic_test_{i}' for i in range(6)]
+    df = pd.DataFrame({'id': ids, 'ground_truth': ['Ad Hominem'] * 6, 'text': [f'text {i}' for i in ids],
+                       'amr': ['(a / amr)'] * 6})
+    (tmp_path / 'run').mkdir()
+    (tmp_path / 'data' / 'outputs').mkdir(parents=True)
+    monkeypatch.chdir(tmp_path / 'run')
+    monkeypatch.setattr(general_request, 'process_data', lambda *args: df.copy())
+    monkeypatch.setattr(general_request, 'ChatOpenAI', lambda **kwargs: None)
+    monkeypatch.setattr(general_request, 'simple_evaluation_str', lambda df, pattern: df)
+    yield f'http://127.0.0.1:{server.server_port}/v1'
+    server.shutdown()
+
+
+def run_main(api_base):
+    general_request.main('input.csv', 'amr.csv', 'logic', True, api_base=api_base, cache_dir='', batch=True,
+                         batch_poll_interval=0)
+    output_file = Path('../data/outputs/requests_amr_logic_true.csv')
+    return (pd.read_csv(output_file, keep_default_na=False),
+            general_request.read_journal(general_request.journal_path(str(output_file))))
+
+
+def test_batch_responses_are_matched_by_custom_id(api):
+    df, journal = run_main(api)
+    assert FakeBatchAPI.submitted == ['batch-0']
+    assert (df['response'] == 'answer ' + df['id']).all()
+    assert journal == {i: 'answer ' + i for i in df['id']}
+    assert not Path('../data/outputs/requests_amr_logic_true_batch.jsonl.id').exists()
+
+
+def test_failed_batch_lines_are_resubmitted(api):
+    FakeBatchAPI.failing = {'logic_test_1', 'logic_test_4'}
+    df, journal = run_main(api)
+    assert set(df.loc[df['response'] == '', 'id']) == {'logic_test_1', 'logic_test_4'}
+    assert set(journal) == set(df['id']) - {'logic_test_1', 'logic_test_4'}
+
+    FakeBatchAPI.failing = set()
+    df, journal = run_main(api)
+    assert FakeBatchAPI.submitted == ['batch-0', 'batch-1']
+    assert sorted(custom_ids(FakeBatchAPI.batches['batch-1']['input'])) == ['logic_test_1', 'logic_test_4']
+    assert (df['response'] == 'answer ' + df['id']).all()
+    assert len(journal) == 6
+
+
+def test_existing_batch_is_polled_instead_of_resubmitted(api):
+    lines = [json.dumps({'custom_id': f'logic_test_{i}'}) for i in range(6)]
+    batch_id = add_batch(add_file('\n'.join(lines).encode('utf-8')))
+    Path('../data/outputs/requests_amr_logic_true_batch.jsonl.id').write_text(batch_id)
+    df, journal = run_main(api)
+    assert FakeBatchAPI.submitted == []
+    assert FakeBatchAPI.batches[batch_id]['polls'] == 2
+    assert (df['response'] == 'answer ' + df['id']).all()
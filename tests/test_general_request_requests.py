@@ -0,0 +1,114 @@
+import asyncio
+import re
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+repo_dir = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(repo_dir))
+
+general_request = pytest.importorskip('general_request')
+
+
+def test_results_are_in_input_order():
+    messages = [f'message {i}' for i in range(8)]
+    completed = []
+
+    async def send(message):
+        # later messages finish first
+        await asyncio.sleep(0.01 * (len(messages) - messages.index(message)))
+        return message.upper()
+
+    results = asyncio.run(general_request.run_requests(
+        send, messages, concurrency=8, on_result=lambda position, response: completed.append(position)))
+    assert results == [m.upper() for m in messages]
+    assert completed == list(reversed(range(len(messages))))
+
+
+def test_failures_are_retried():
+    attempts = []
+
+    async def send(message):
+        attempts.append(message)
+        if len(attempts) < 3:
+            raise ConnectionError('try again')
+        return 'ok'
+
+    assert asyncio.run(general_request.request_with_retry(send, 'm', max_retries=3, backoff=0)) == 'ok'
+    assert len(attempts) == 3
+
+
+def test_exhausted_retries_give_none():
+    attempts = []
+
+    async def send(message):
+        attempts.append(message)
+        raise ConnectionError('down')
+
+    assert asyncio.run(general_request.request_with_retry(send, 'm', max_retries=2, backoff=0)) is None
+    assert len(attempts) == 3
+
+
+def test_rate_limiter_holds_requests_per_minute(monkeypatch):
+    # a virtual clock that only moves when the limiter sleeps
+    clock = [0.0]
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        clock[0] += seconds
+        await real_sleep(0)
+
+    monkeypatch.setattr(general_request, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+    acquired = []
+
+    async def run():
+        limiter = general_request.RateLimiter(requests_per_minute=5)
+
+        async def acquire():
+            await limiter.acquire(1)
+            acquired.append(clock[0])
+
+        await asyncio.gather(*(acquire() for _ in range(12)))
+
+    asyncio.run(run())
+    assert len(acquired) == 12
+    assert max(sum(start <= t < start + 60 for t in acquired) for start in acquired) == 5
+    assert acquired[-1] >= 120
+
+
+class FakeChat:
+    """Stands in for ChatOpenAI: answers with the 'text N' in the prompt and always fails for a 'broken' one."""
+    def __init__(self, **kwargs):
+        pass
+
+    async def apredict_messages(self, messages):
+        text = messages[-1].content
+        if 'broken' in text:
+            raise ConnectionError('server error')
+        return SimpleNamespace(content='answer ' + re.search(r'text \d', text).group())
+
+
+def test_failed_requests_stay_out_of_the_journal(tmp_path, monkeypatch):
+    ids = [f'logic_test_{i}' for i in range(5)]
+    texts = ['text 0', 'text 1', 'broken text', 'text 3', 'text 4']
+    df = pd.DataFrame({'id': ids, 'ground_truth': ['Ad Hominem'] * 5, 'text': texts, 'amr': ['(a / amr)'] * 5})
+    (tmp_path / 'run').mkdir()
+    (tmp_path / 'data' / 'outputs').mkdir(parents=True)
+    monkeypatch.chdir(tmp_path / 'run')
+    monkeypatch.setattr(general_request, 'process_data', lambda *args: df.copy())
+    monkeypatch.setattr(general_request, 'ChatOpenAI', FakeChat)
+    monkeypatch.setattr(general_request, 'simple_evaluation_str', lambda df, pattern: df)
+    monkeypatch.setattr(general_request.random, 'random', lambda: 0.0)
+
+    general_request.main('input.csv', 'amr.csv', 'logic', False, max_retries=1, cache_dir='')
+    output_file = '../data/outputs/requests_direct_logic.csv'
+    out = pd.read_csv(output_file, keep_default_na=False)
+    journal = general_request.read_journal(general_request.journal_path(output_file))
+    assert set(journal) == set(ids) - {'logic_test_2'}
+    assert out.loc[out['id'] == 'logic_test_2', 'response'].item() == ''
+    assert journal == {i: 'answer ' + t for i, t in zip(ids, texts) if i != 'logic_test_2'}
+    assert (out.set_index('id').loc[list(journal), 'response'] == pd.Series(journal)).all()
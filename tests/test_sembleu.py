@@ -0,0 +1,41 @@
+import os
+import sys
+from collections import Counter
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+repo_dir = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(repo_dir))
+
+import amr_score
+
+
+def test_amr_ngrams():
+    assert amr_score.amr_ngrams('(w / want-01 :ARG0 (b / boy) :ARG1 (g / go-01 :ARG0 b :polarity -))') == Counter({
+        ('want-01',): 1, ('boy',): 1, ('go-01',): 1, ('-',): 1,
+        ('want-01', 'ARG0', 'boy'): 1, ('want-01', 'ARG1', 'go-01'): 1,
+        ('go-01', 'ARG0', 'boy'): 1, ('go-01', 'polarity', '-'): 1,
+        ('want-01', 'ARG1', 'go-01', 'ARG0', 'boy'): 1, ('want-01', 'ARG1', 'go-01', 'polarity', '-'): 1,
+    })
+
+
+def test_sembleu_scores():
+    # one of two unigrams and none of the bigrams match: sqrt(1/2 * 1/(2*1)) with NIST smoothing
+    assert amr_score.sembleu_scores(['(w / want-01 :ARG0 (b / boy))', '(w / want-01 :ARG0 (b / boy))', '(w'],
+                                    ['(w / want-01 :ARG0 (b / boy))', '(w / want-01 :ARG0 (g / girl))',
+                                     '(w / want-01)']) == [1.0, pytest.approx(0.5), None]
+
+
+@pytest.mark.skipif(not os.path.exists(f'{amr_score.sembleu_dir}/eval.sh'),
+                    reason='needs the reference SemBLEU checkout next to the project')
+def test_sembleu_matches_eval_sh(tmp_path):
+    df = pd.read_csv(repo_dir / 'final_results_ner_true.csv', usecols=['amr', 'true_amr'], nrows=10)
+    df['amr'] = df['amr'].map(amr_score.normalize_amr)
+    native = amr_score.sembleu_scores(df['amr'], df['true_amr'])
+    for hypothesis, reference, score in zip(df['amr'], df['true_amr'], native):
+        (tmp_path / 'hyp.txt').write_text(hypothesis)
+        (tmp_path / 'ref.txt').write_text(reference)
+        reference_score = amr_score.eval_sh_sembleu(tmp_path / 'hyp.txt', tmp_path / 'ref.txt')
+        assert score == pytest.approx(float(reference_score), abs=1e-4)
@@ -1,7 +1,10 @@
 import pandas as pd
-from transformers import RobertaTokenizer, RobertaForSequenceClassification, AdamW
+from transformers import RobertaTokenizerFast, RobertaForSequenceClassification, AdamW
 import torch
-from transformers import Trainer, TrainingArguments
+from transformers import Trainer, TrainingArguments, DataCollatorWithPadding, default_data_collator
+from transformers import AutoConfig
+from transformers.modeling_outputs import SequenceClassifierOutput
+from transformers.models.roberta.modeling_roberta import RobertaClassificationHead
 import numpy as np
 from datasets import Dataset, DatasetDict
 from sklearn.metrics import accuracy_score, recall_score, precision_score, f1_score
@@ -12,7 +15,14 @@ from sklearn.model_selection import train_test_split
 from sklearn.utils import class_weight
 from torch import nn
 import transformers
+from transformers.trainer_pt_utils import LengthGroupedSampler
+import hashlib
+import inspect
+import os
+import time
 import wandb
+from result_store import load_results
+from dataset_cache import tokenized_cache_key, cached_tokenized_dataset
 
 def compute_metrics_discrete(eval_pred):
     logits, labels = eval_pred
@@ -39,7 +49,8 @@ def compute_metrics_discrete(eval_pred):
 
 def process_data(file_path,dataset,amr=True,outcome_variable='helpfulness'):
     """Process data for training RoBERTa model, formatting depends on the dataset"""
-    df=pd.read_csv(file_path)
+    text_columns=['premise_','hypothesis_','amr_p','amr_h','text','amr','interaction']
+    df=load_results(file_path,columns=['id',outcome_variable]+text_columns)
     if amr:
         if dataset in ['PAWS']:
             df=df.assign(text="Sentence 1: "+df.premise_+"\nAMR 1: "+df.amr_p+"\nSentence 2: "+df.hypothesis_+"\nAMR 2: "+df.amr_h)
@@ -81,7 +92,8 @@ def split_sets(dataset,df):
 
 
 def tokenize(batch):
-    return tokenizer(batch["text"], padding=True, truncation=True, max_length=512)
+    # no padding here: DataCollatorWithPadding pads each batch to its own longest sequence
+    return tokenizer(batch["text"], truncation=True, max_length=max_length)
 
 def model_init():
     transformers.set_seed(42)
@@ -117,6 +129,91 @@ def freeze_weights(m):
     for name, param in m.named_parameters():
         param.requires_grad = False  
 
+def encoder_features(model, ds, path, batch_size=64):
+    """<s> hidden states of the frozen encoder for every row of ds, computed once into a memory-mapped .npy file"""
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8)
+    ds = ds.select_columns(['input_ids', 'attention_mask'])
+    order = np.argsort([len(x) for x in ds['input_ids']])
+    tmp = path[:-len('.npy')] + '.tmp.npy'
+    features = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(ds), model.config.hidden_size))
+    model.eval()
+    with torch.no_grad():
+        for i in range(0, len(order), batch_size):
+            idx = order[i:i + batch_size]
+            batch = collator([ds[int(j)] for j in idx])
+            features[idx] = model.roberta(**batch.to(model.device)).last_hidden_state[:, 0, :].float().cpu().numpy()
+    features.flush()
+    del features
+    os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """Rows of the cached encoder features with their labels"""
+    def __init__(self, features, rows, labels):
+        self.features = features
+        self.rows = list(rows)
+        self.labels = list(labels)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return {'features': torch.tensor(self.features[self.rows[i]]), 'labels': torch.tensor(self.labels[i])}
+
+class ClassifierHead(nn.Module):
+    """The classification head of RobertaForSequenceClassification trained on cached <s> features"""
+    def __init__(self, classifier, config):
+        super().__init__()
+        self.classifier = classifier
+        self.config = config
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def forward(self, features, labels=None):
+        # RobertaClassificationHead reads position 0 of its input
+        return SequenceClassifierOutput(logits=self.classifier(features.unsqueeze(1)))
+
+def head_model_init():
+    """A freshly initialized head, built from the config alone instead of loading the whole checkpoint"""
+    transformers.set_seed(42)
+    config = AutoConfig.from_pretrained(tokenizer_name, num_labels=2)
+    classifier = RobertaClassificationHead(config)
+    # same init as RobertaPreTrainedModel._init_weights
+    for module in classifier.modules():
+        if isinstance(module, nn.Linear):
+            module.weight.data.normal_(mean=0.0, std=config.initializer_range)
+            module.bias.data.zero_()
+    return ClassifierHead(classifier, config)
+
+def benchmark_padding(model, texts, batch_size=32):
+    """Forward-pass throughput in real (non-pad) tokens/sec: padding the whole split to its longest
+    sequence (the old tokenize) vs per-batch padding over length-grouped batches"""
+    ids = tokenizer(list(texts), truncation=True, max_length=512)['input_ids']
+    lengths = [len(x) for x in ids]
+    sequential = list(range(len(ids)))
+    grouped = list(LengthGroupedSampler(batch_size, lengths=lengths))
+    model.eval()
+    for name, order, max_length in [('split padding', sequential, max(lengths)), ('dynamic padding', grouped, None)]:
+        real = padded = 0
+        start = time.time()
+        with torch.no_grad():
+            for i in range(0, len(order), batch_size):
+                features = [{'input_ids': ids[j]} for j in order[i:i + batch_size]]
+                if max_length:
+                    batch = tokenizer.pad(features, padding='max_length', max_length=max_length, return_tensors='pt')
+                else:
+                    batch = tokenizer.pad(features, padding='longest', pad_to_multiple_of=8, return_tensors='pt')
+                model(**batch.to(model.device))
+                real += int(batch['attention_mask'].sum())
+                padded += batch['input_ids'].numel()
+        elapsed = time.time() - start
+        print(f"{name}: {real/elapsed:.0f} tokens/sec, {1-real/padded:.1%} pad tokens, {elapsed:.1f}s")
+
 
 sweep_config = {
     'method': 'random'
@@ -150,13 +247,31 @@ d_metric='f1_1'
 amr_flag=True
 decision_metric='eval_'+d_metric
 outcome_variable='helpfulness'
+## compare tokens/sec of split-wide vs per-batch padding on the train set before training
+run_padding_benchmark=False
+## optional, for a fully frozen encoder (not logic/pubmed): run it once, cache the <s> features and train only
+## the head on them. Features are computed without encoder dropout, so results differ from the default setup
+cache_encoder_features=False
 ## final results files
 ##https://drive.google.com/drive/folders/17pwdiiu7U1oyly8YwMtqCRdu3GBIWT3K
 file_path='final_results_pubmed_corrected.csv'
 logs_path=''
 run_name=dataset+"_hyp_final_"+outcome_variable
 
-df=process_data(file_path=file_path,dataset=dataset,amr=amr_flag,outcome_variable=outcome_variable)
+max_length=512
+tokenizer_name='roberta-base' if dataset in ['logic', 'pubmed'] else 'roberta-large'
+tokenizer = RobertaTokenizerFast.from_pretrained(tokenizer_name)
+
+def build_dataset():
+    df=process_data(file_path=file_path,dataset=dataset,amr=amr_flag,outcome_variable=outcome_variable)
+    return Dataset.from_pandas(df,preserve_index=False).map(tokenize, batched=True)
+
+## tokenized rows are cached on disk; sampling and splitting below select from them by row number
+cache_key=tokenized_cache_key(file_path,dataset,amr_flag,outcome_variable,tokenizer_name,max_length,
+                              inspect.getsource(process_data))
+tokenized=cached_tokenized_dataset(cache_key,build_dataset)
+df=tokenized.select_columns(['id','text','label']).to_pandas()
+df['row']=np.arange(len(df))
 
 # Undersampling of data in order to avoid huge data imbalance
 
@@ -194,21 +309,26 @@ else:
 ## prepare sets
 set_seed(42)
 torch.manual_seed(42)
-if dataset in ['logic', 'pubmed']:
-    tokenizer = RobertaTokenizer.from_pretrained('roberta-base')
-else:
-    tokenizer = RobertaTokenizer.from_pretrained('roberta-large')
-
-train_dataset=Dataset.from_pandas(train_set)
-val_dataset=Dataset.from_pandas(dev_set)
-test_dataset=Dataset.from_pandas(test_set)
-train_dataset = train_dataset.map(tokenize, batched=True, batch_size=len(train_dataset))
-val_dataset = val_dataset.map(tokenize, batched=True, batch_size=len(val_dataset))
-test_dataset = test_dataset.map(tokenize, batched=True, batch_size=len(test_dataset))
+
+train_dataset=tokenized.select(train_set.row.tolist())
+val_dataset=tokenized.select(dev_set.row.tolist())
+test_dataset=tokenized.select(test_set.row.tolist())
 train_dataset.set_format("torch", columns=["input_ids", "attention_mask", "label"])
 val_dataset.set_format("torch", columns=["input_ids", "attention_mask", "label"])
 test_dataset.set_format("torch", columns=["input_ids", "attention_mask", "label"])
 
+if run_padding_benchmark:
+    benchmark_padding(model_init(), train_set.text, batch_size=32)
+
+if cache_encoder_features:
+    ## only the rows kept by the sampling and splitting above are encoded
+    feature_rows=np.unique(np.concatenate([train_set.row, dev_set.row, test_set.row]))
+    features_key=cache_key+'_'+hashlib.sha256(feature_rows.tobytes()).hexdigest()[:16]
+    features=encoder_features(model_init(), tokenized.select(feature_rows.tolist()), 'cache/features/'+features_key+'.npy')
+    train_dataset=FeatureDataset(features, np.searchsorted(feature_rows, train_set.row), train_set.label)
+    val_dataset=FeatureDataset(features, np.searchsorted(feature_rows, dev_set.row), dev_set.label)
+    test_dataset=FeatureDataset(features, np.searchsorted(feature_rows, test_set.row), test_set.label)
+
 training_args = TrainingArguments(
     output_dir=logs_path+'results/'+run_name,
     report_to=None,
@@ -228,14 +348,16 @@ training_args = TrainingArguments(
     load_best_model_at_end=True,
     metric_for_best_model=decision_metric,
     greater_is_better=True,
+    group_by_length=not cache_encoder_features,
 )
 
 trainer = CustomTrainer(
-    model_init=model_init,
+    model_init=head_model_init if cache_encoder_features else model_init,
     args=training_args,
     train_dataset=train_dataset,
     eval_dataset=val_dataset,
     compute_metrics=compute_metrics_discrete,
+    data_collator=default_data_collator if cache_encoder_features else DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8),
 )
 trainer.train()
 
@@ -252,4 +374,10 @@ print("Dataset: ",dataset)
 print("Decision metric ",'test_',d_metric,": ",res.metrics['test_'+d_metric])
 
 
-trainer.save_model(logs_path+"models/"+run_name)
\ No newline at end of file
+if cache_encoder_features:
+    # save a full RobertaForSequenceClassification so evaluate_roberta can load it
+    m=model_init()
+    m.classifier.load_state_dict(trainer.model.classifier.state_dict())
+    m.save_pretrained(logs_path+"models/"+run_name)
+else:
+    trainer.save_model(logs_path+"models/"+run_name)
\ No newline at end of file